@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+'''
+measure how long the invoice generator takes to get going, and fail
+if that goes over budget, so that slow imports creeping back into
+startup get noticed
+'''
+import getopt
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# modules that are only needed for real work, which --help must not import
+HEAVY_MODULES = ['yaml', 'fpdf', 'invoice_pdf', 'smtplib', 'ssl', 'email.message',
+                 'tarfile', 'zipfile']
+# default budgets in milliseconds, for the time spent importing modules
+# that python doesn't import on its own, and for the wall clock time
+# beyond that of starting python to do nothing
+IMPORT_BUDGET = 50
+STARTUP_BUDGET = 100
+
+
+def usage(message=None):
+    '''
+    display a helpful usage message with
+    an optional introductory message first
+    '''
+    if message is not None:
+        sys.stderr.write(message)
+        sys.stderr.write("\n")
+    usage_message = """
+Usage: python3 bench_startup.py [--runs <n>] [--import-budget <ms>]
+                 [--startup-budget <ms>] [--zipapp <path>] [-- <args>]
+
+This script runs the invoice generator (by default with --help, which
+does no real work) several times, and reports how long it takes to start
+up beyond python itself and how much of that goes to importing modules,
+as measured by python -X importtime. It exits with an error if either is
+over budget, or if --help imports any of the modules that are only
+needed to generate invoices.
+
+--runs           (-n):  number of runs to take the median of, default 10
+--import-budget  (-i):  budget for import time in ms, default %d
+--startup-budget (-s):  budget for startup time beyond python's in ms, default %d
+--zipapp         (-z):  measure this zipapp (see build_zipapp.py) instead of
+                        generate_pdf.py
+--help           (-h):  display this help message
+
+Anything after -- is passed to the invoice generator instead of --help.
+""" % (IMPORT_BUDGET, STARTUP_BUDGET)
+    sys.stderr.write(usage_message)
+    sys.exit(1)
+
+
+def get_args():
+    '''get and validate command-line args, return them in a dict'''
+    args = {'runs': 10, 'import_budget': IMPORT_BUDGET, 'startup_budget': STARTUP_BUDGET,
+            'zipapp': None, 'args': ['--help']}
+    try:
+        (options, remainder) = getopt.getopt(
+            sys.argv[1:], "n:i:s:z:h",
+            ["runs=", "import-budget=", "startup-budget=", "zipapp=", "help"])
+    except getopt.GetoptError as err:
+        usage("Unknown option specified: " + str(err))
+
+    try:
+        for (opt, val) in options:
+            if opt in ["-n", "--runs"]:
+                args['runs'] = int(val)
+            elif opt in ["-i", "--import-budget"]:
+                args['import_budget'] = float(val)
+            elif opt in ["-s", "--startup-budget"]:
+                args['startup_budget'] = float(val)
+            elif opt in ["-z", "--zipapp"]:
+                args['zipapp'] = val
+            elif opt in ["-h", "--help"]:
+                usage("Help for this script")
+    except ValueError as err:
+        usage("Bad option value: " + str(err))
+
+    if remainder:
+        args['args'] = remainder
+
+    if args['runs'] < 1:
+        usage("The 'runs' option must be at least 1")
+
+    if args['zipapp'] and not os.path.exists(args['zipapp']):
+        usage("No such file: " + args['zipapp'])
+
+    return args
+
+
+def time_run(command):
+    '''run the command and return how long it took in ms'''
+    start = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    return (time.perf_counter() - start) * 1000
+
+
+def get_median_time(command, runs):
+    '''run the command the given number of times and return the median time in ms'''
+    return statistics.median([time_run(command) for _unused in range(runs)])
+
+
+def get_imports(command):
+    '''
+    run the command with python -X importtime and return a dict of
+    the modules it imported -> time spent importing each one itself
+    (not counting the modules it imports), in ms
+    '''
+    result = subprocess.run(command[:1] + ['-X', 'importtime'] + command[1:],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=False)
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        imports[fields[2].strip()] = int(fields[0]) / 1000
+    return imports
+
+
+def do_main():
+    '''entry point'''
+    args = get_args()
+    if args['zipapp']:
+        command = [sys.executable, args['zipapp']] + args['args']
+    else:
+        here = os.path.dirname(os.path.abspath(__file__))
+        command = [sys.executable, os.path.join(here, 'generate_pdf.py')] + args['args']
+    bare = [sys.executable, '-c', 'pass']
+
+    python_time = get_median_time(bare, args['runs'])
+    startup_time = get_median_time(command, args['runs']) - python_time
+    python_imports = get_imports(bare)
+    imports = dict((module, elapsed) for module, elapsed in get_imports(command).items()
+                   if module not in python_imports)
+    import_time = sum(imports.values())
+
+    sys.stdout.write("startup: {startup:.1f} ms beyond python's {python:.1f} ms "
+                     "(budget {budget:.0f} ms)\n".format(
+                         startup=startup_time, python=python_time,
+                         budget=args['startup_budget']))
+    sys.stdout.write("imports: {imports:.1f} ms for {count} modules (budget {budget:.0f} ms)\n"
+                     .format(imports=import_time, count=len(imports),
+                             budget=args['import_budget']))
+    slowest = sorted(imports.items(), key=lambda item: item[1], reverse=True)[:5]
+    sys.stdout.write("slowest: " + ", ".join(["{module} {elapsed:.1f} ms".format(
+        module=module, elapsed=elapsed) for module, elapsed in slowest]) + "\n")
+
+    over = []
+    if startup_time > args['startup_budget']:
+        over.append("startup time is over budget")
+    if import_time > args['import_budget']:
+        over.append("import time is over budget")
+    if args['args'] == ['--help']:
+        heavy = [module for module in HEAVY_MODULES if module in imports]
+        if heavy:
+            over.append("--help imports " + ", ".join(heavy))
+    for message in over:
+        sys.stderr.write(message + "\n")
+    if over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    do_main()
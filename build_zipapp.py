@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+'''
+build a self-contained zipapp of the invoice generator, holding its
+own copies of the libraries it uses along with precompiled bytecode,
+so that it runs with just a python interpreter and starts without
+having to compile anything first
+'''
+import getopt
+import importlib.util
+import os
+import py_compile
+import shutil
+import sys
+import tempfile
+import zipapp
+
+
+# our modules, and the libraries bundled along with them
+MODULES = ['generate_pdf.py', 'invoice_pdf.py']
+PACKAGES = ['yaml', 'fpdf']
+
+MAIN = '''import generate_pdf
+generate_pdf.do_main()
+'''
+
+
+def usage(message=None):
+    '''
+    display a helpful usage message with
+    an optional introductory message first
+    '''
+    if message is not None:
+        sys.stderr.write(message)
+        sys.stderr.write("\n")
+    usage_message = """
+Usage: python3 build_zipapp.py [--output <path>] [--no-packages]
+
+This script builds the invoice generator into a single file that can be
+run with "python3 <path> --values ... --template ..." anywhere the same
+version of python is installed; the bytecode in it is for the python
+that runs this script.
+
+--output      (-o):  path to the zipapp to write, default dist/generate_pdf.pyz
+--no-packages (-n):  leave out the libraries (yaml, fpdf), to use the ones
+                     installed wherever the zipapp is run instead
+--help        (-h):  display this help message
+"""
+    sys.stderr.write(usage_message)
+    sys.exit(1)
+
+
+def get_args():
+    '''get and validate command-line args, return them in a dict'''
+    args = {'output': os.path.join('dist', 'generate_pdf.pyz'), 'packages': True}
+    try:
+        (options, remainder) = getopt.gnu_getopt(
+            sys.argv[1:], "o:nh", ["output=", "no-packages", "help"])
+    except getopt.GetoptError as err:
+        usage("Unknown option specified: " + str(err))
+
+    for (opt, val) in options:
+        if opt in ["-o", "--output"]:
+            args['output'] = val
+        elif opt in ["-n", "--no-packages"]:
+            args['packages'] = False
+        elif opt in ["-h", "--help"]:
+            usage("Help for this script")
+
+    if remainder:
+        usage("Unknown option(s) specified: %s" % remainder[0])
+
+    return args
+
+
+def copy_package(name, staging):
+    '''
+    copy the installed package into the staging directory, leaving out
+    compiled extensions, which can't be imported from a zip file; the
+    packages we bundle fall back to pure python without them
+    '''
+    spec = importlib.util.find_spec(name)
+    if spec is None or not spec.submodule_search_locations:
+        raise RuntimeError("Package " + name + " is not installed")
+    shutil.copytree(list(spec.submodule_search_locations)[0], os.path.join(staging, name),
+                    ignore=shutil.ignore_patterns('__pycache__', '*.pyc', '*.so', '*.pyd'))
+
+
+def compile_all(staging):
+    '''
+    compile every module in the staging directory to a .pyc file next to
+    it, which is where zipimport looks for them; the bytecode isn't checked
+    against the source, since neither can change once they are zipped up
+    '''
+    for dirpath, _dirnames, filenames in os.walk(staging):
+        for filename in filenames:
+            if filename.endswith('.py'):
+                path = os.path.join(dirpath, filename)
+                py_compile.compile(
+                    path, cfile=path + 'c', dfile=os.path.relpath(path, staging), doraise=True,
+                    invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+
+
+def build(output, packages=True):
+    '''build the zipapp and write it to output'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    staging = tempfile.mkdtemp()
+    try:
+        for module in MODULES:
+            shutil.copy(os.path.join(here, module), staging)
+        with open(os.path.join(staging, '__main__.py'), 'w') as fhandle:
+            fhandle.write(MAIN)
+        if packages:
+            for package in PACKAGES:
+                copy_package(package, staging)
+        compile_all(staging)
+        if os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        zipapp.create_archive(staging, output, interpreter='/usr/bin/env python3')
+    finally:
+        shutil.rmtree(staging)
+
+
+def do_main():
+    '''entry point'''
+    args = get_args()
+    try:
+        build(args['output'], args['packages'])
+    except (OSError, RuntimeError, py_compile.PyCompileError) as err:
+        sys.stderr.write("Failed to build " + args['output'] + ": " + str(err) + "\n")
+        sys.exit(1)
+    sys.stderr.write("Wrote " + args['output'] + "\n")
+
+
+if __name__ == '__main__':
+    do_main()
@@ -3,14 +3,25 @@
 write an invoice based on config to
 pdf, with optional logo
 '''
+import collections
 import getopt
 import os
+import queue
 import sys
+import threading
 import time
+import bisect
 import calendar
+import csv
 import datetime
-import yaml
-from fpdf import FPDF
+import decimal
+import io
+import json
+# yaml, fpdf (via invoice_pdf) and the modules for archiving and mailing
+# are slow to import, so they are imported where they are used; --help
+# and bad arguments then don't wait on them, and runs that don't archive
+# or mail never load those modules
+# pylint: disable=import-outside-toplevel
 
 
 FIELDS = {
@@ -26,238 +37,117 @@ FIELDS = {
     }
 
 
-class PDF(FPDF):
-    '''
-    subclass with invoice header, footer
-    and some methods to set text, draw and
-    fill colors based on config
-    '''
-    def __init__(self, config):
-        self.config = config
-        super().__init__()
-        self.add_font('DejaVu', '', '/usr/share/fonts/dejavu/DejaVuSerif.ttf', uni=True)
-        self.add_font('DejaVu', 'B', '/usr/share/fonts/dejavu/DejaVuSerif-Bold.ttf', uni=True)
-        self.add_fonts_from_config()
-        self.margin = 8
-        # A4 paper size. This must be adjusted if caller doesn't use A4.
-        self.page_width = 210 - 16
-
-    def add_fonts_from_config(self):
-        '''
-        we are doing unicode fonts now. explicitly add them if specified
-        in the template
-        '''
-        if 'sans_font' in self.config['app_config']:
-            if 'sans_font_path' in self.config['app_config']:
-                self.add_font(self.config['app_config']['sans_font'], '',
-                              self.config['app_config']['sans_font_path'], uni=True)
-            if 'sans_font_bold_path' in self.config['app_config']:
-                self.add_font(self.config['app_config']['sans_font'], 'B',
-                              self.config['app_config']['sans_font_bold_path'], uni=True)
-            if 'sans_font_bolditalic_path' in self.config['app_config']:
-                self.add_font(self.config['app_config']['sans_font'], 'BI',
-                              self.config['app_config']['sans_fontitalic_bold_path'], uni=True)
-        if 'serif_font' in self.config['app_config']:
-            if 'serif_font_path' in self.config['app_config']:
-                self.add_font(self.config['app_config']['serif_font'], '',
-                              self.config['app_config']['serif_font_path'], uni=True)
-            if 'serif_font_bold_path' in self.config['app_config']:
-                self.add_font(self.config['app_config']['serif_font'], 'B',
-                              self.config['app_config']['serif_font_bold_path'], uni=True)
-
-    def dark_text(self):
-        '''
-        set the text color to the dark color per config
-        '''
-        self.set_text_color(
-            self.config['colors']['color_dark']['r'],
-            self.config['colors']['color_dark']['g'],
-            self.config['colors']['color_dark']['b'])
+class InvoiceError(Exception):
+    '''an invoice entry can't be generated from its config'''
 
-    def light_text(self):
-        '''
-        set the text color to the light color per config
-        '''
-        self.set_text_color(
-            self.config['colors']['color_light']['r'],
-            self.config['colors']['color_light']['g'],
-            self.config['colors']['color_light']['b'])
-
-    def dark_draw_color(self):
-        '''
-        set the draw color to the dark color per config
-        '''
-        self.set_draw_color(
-            self.config['colors']['color_dark']['r'],
-            self.config['colors']['color_dark']['g'],
-            self.config['colors']['color_dark']['b'])
 
-    def light_fill_color(self):
-        '''
-        set the fill color to the light color per config
-        '''
-        self.set_fill_color(
-            self.config['colors']['color_light']['r'],
-            self.config['colors']['color_light']['g'],
-            self.config['colors']['color_light']['b'])
+class Color(collections.namedtuple('Color', ['r', 'g', 'b'])):
+    '''an rgb color, each value from 0 to 255'''
+    __slots__ = ()
 
-    def black_text(self):
-        '''
-        set the text color to black
-        '''
-        self.set_text_color(0, 0, 0)
+    @staticmethod
+    def from_config(color):
+        '''given a color dict from the config, return the Color'''
+        return Color(int(color['r']), int(color['g']), int(color['b']))
 
-    def white_text(self):
-        '''
-        set the text color to white
-        '''
-        self.set_text_color(255, 255, 255)
 
-    def serif(self, fontsize):
-        '''
-        set the font to plain serif of the specified size
-        '''
-        self.set_font(self.config['app_config']['serif_font'], "", fontsize)
+class Business(collections.namedtuple('Business', ['name', 'person', 'address',
+                                                   'image_file'])):
+    '''the biller; image_file is None if there is no logo'''
+    __slots__ = ()
 
-    def bold_serif(self, fontsize):
-        '''
-        set the font to bold serif of the specified size
-        '''
-        self.set_font(self.config['app_config']['serif_font'], "B", fontsize)
 
-    def content_cell(self, width, height, text):
-        '''
-        write a filled framed cell with right aligned text
-        which is what we want for most content cells in the
-        invoice tables
-        '''
-        self.cell(width, height, text, border=1, align="R", fill=True)
+class Bill(collections.namedtuple('Bill', ['department', 'currency', 'payment_terms',
+                                           'due_date'])):
+    '''description fields for the bill, in the order they are displayed'''
+    __slots__ = ()
 
-    def content_cell_left(self, width, height, text):
-        '''
-        write a filled framed cell with left aligned text
-        which a few content cells need
-        '''
-        self.cell(width, height, text, border=1, fill=True)
 
-    def header_cell(self, width, height, text):
-        '''
-        write a filled framed cell with centered text
-        which is what we want for most header cells in the
-        invoice tables
-        '''
-        self.cell(width, height, text, border=1, align="C", fill=True)
+class Billable(collections.namedtuple('Billable', ['description', 'hours', 'rate', 'cost'])):
+    '''a billable item, with hours as a Decimal and rate and cost in cents'''
+    __slots__ = ()
 
-    def blank_cell(self, width, height):
-        '''
-        write a transparent borderless cell with no text, which is the
-        default for all the args except of course for the empty
-        text string
-        '''
-        # self.cell(width, height, "", align="C", fill=True)
-        self.cell(width, height, "")
 
-    def get_invoice_date(self):
-        '''
-        from the bill date, figure out the invoice date, which is
-        in the format "Monthname daynum, Year"
-        '''
-        year, month, last_day = self.config['billdate'].split('-')
-        month = int(month)
-        month_name = calendar.month_name[month]
-        last_day = int(last_day)
-        return "{name} {day}, {year}".format(name=month_name, day=last_day, year=year)
+class Invoice(collections.namedtuple('Invoice', [
+        'billdate', 'invoice_date', 'invoice_number', 'business', 'bill_to', 'bill_to_email',
+        'bill',
+        'work_done', 'billables', 'currency_code', 'currency_marker', 'home_currency',
+        'tax_name', 'subtotal', 'tax', 'total', 'color_light', 'color_dark',
+        'sans_font', 'serif_font', 'fonts', 'output_dir'])):
+    '''
+    everything needed to draw one invoice, converted from its yaml config
+    once, so that drawing doesn't have to look things up in nested dicts
+    or turn strings into money over and over
+
+    bill_to and work_done are tuples of the lines to display, bill_to_email
+    is the address to send the invoice to, or None, amounts are
+    in cents, colors are Colors, and fonts is a tuple of (family, style,
+    path) for the unicode fonts to add from the template
+    '''
+    __slots__ = ()
 
-    def get_invoice_number(self):
+    @staticmethod
+    def from_config(config):
         '''
-        from the bill date, figure out the invoice number, which is
-        in the format "MonthabbrevDaynumYear"
+        given a yaml config for an invoice, with defaults added and
+        due date set, that has passed validation, return the Invoice
         '''
-        year, month, last_day = self.config['billdate'].split('-')
-        month = int(month)
-        month_name = calendar.month_name[month]
-        last_day = int(last_day)
-        return "{name}{day}{year}".format(name=month_name[0:3], day=last_day, year=year)
+        billables = []
+        for item in config['billables']:
+            hours = decimal.Decimal(str(item['hours']))
+            rate = InvoiceUtils.convert_money(str(item['rate']))
+            if 'cost' in item:
+                cost = InvoiceUtils.convert_money(str(item['cost']))
+            else:
+                cost = InvoiceUtils.get_cost(rate, hours)
+            billables.append(Billable(item['description'], hours, rate, cost))
+        subtotal = sum([billable.cost for billable in billables])
 
-    def draw_divider(self, ypos):
-        '''draw a dividing line across the page 10 line breaks below our current pos'''
-        self.ln(10)
-        self.dark_draw_color()
-        self.line(self.margin, ypos, self.page_width + self.margin, ypos)
-
-    def header(self):
-        '''
-        Display at top of the invoice:
-        logo if any, biller name and address, invoice number and date,
-        divider line to separate the header from the body of the invoice
-        '''
-        # logo
-        self.image(self.config['business']['image_file'], 0, 10, 100, 0, '', '')
-
-        # Right side
-        # "Invoice"
-        right_x = 140
-        self.set_font(self.config['app_config']['sans_font'], "BI", 28)
-        self.set_xy(right_x, 30)
-        self.dark_text()
-        self.cell(40, 0, FIELDS['header']['invoice'])
-
-        # Rest of right side
-        self.serif(10)
-        right_width = 20
-        # "Date"
-        self.set_xy(right_x, 40)
-        self.dark_text()
-        self.cell(right_width, 0, FIELDS['header']['date'])
-        self.light_text()
-        self.cell(20, 0, self.get_invoice_date())
-        # "Invoice Number"
-        self.set_xy(right_x, 45)
-        self.dark_text()
-        self.cell(right_width, 0, FIELDS['header']['invoice_num'])
-        self.light_text()
-        self.cell(right_width, 0, self.get_invoice_number())
-
-        # Left side
-        self.dark_text()
-        left_width = 40
-        # Biller Name
-        self.bold_serif(14)
-        self.set_xy(self.margin, 40)
-        self.cell(left_width, 0, self.config['business']['person'])
-        # Biller Address
-        self.serif(9)
-        self.set_xy(self.margin, 45)
-        self.cell(left_width, 0, self.config['business']['address'])
-
-        self.draw_divider(50)
-
-    def footer(self):
-        '''
-        Display at bottom of the invoice:
-        divider line to separate footer from body of the invoice,
-        company name, date invoice generated
-        '''
-        self.draw_divider(275)
-
-        # Text
-        self.bold_serif(10)
-
-        # Left side
-        # company name
-        self.set_xy(self.margin, 280)
-        self.dark_text()
-        company_text = self.config['business']['name']
-        self.cell(self.get_string_width(company_text), 0, company_text)
-
-        # Right side
-        # invoice generation date
-        self.light_text()
-        time_text = FIELDS['footer']['generated'] + ' '  + time.strftime(
-            "%Y-%m-%d %H:%M:%S UTC", time.gmtime())
-        # add in left margin for correct placement
-        self.set_x(self.page_width - self.get_string_width(time_text) + self.margin)
-        self.cell(self.get_string_width(time_text), 0, time_text)
+        tax = 0
+        tax_name = FIELDS['totals']['tax']
+        if config['tax_details'] is not None:
+            tax = int(subtotal * config['tax_details']['default_percentage'] / 100)
+            if config['tax_details'].get('tax_name'):
+                tax_name = config['tax_details']['tax_name']
+
+        app_config = config['app_config']
+        fonts = []
+        for family, settings in [('sans_font', [('', 'sans_font_path'),
+                                                ('B', 'sans_font_bold_path'),
+                                                ('BI', 'sans_font_bolditalic_path')]),
+                                 ('serif_font', [('', 'serif_font_path'),
+                                                 ('B', 'serif_font_bold_path')])]:
+            for style, setting in settings:
+                if setting in app_config:
+                    fonts.append((app_config[family], style, app_config[setting]))
+
+        business = config['business']
+        fields = ['email', 'name', 'street', 'city_state_zip', 'country']
+        return Invoice(
+            billdate=config['billdate'],
+            invoice_date=InvoiceUtils.get_invoice_date(config['billdate']),
+            invoice_number=InvoiceUtils.get_invoice_number(config['billdate']),
+            business=Business(business['name'], business['person'], business['address'],
+                              business.get('image_file')),
+            bill_to=tuple([config['bill_to'][field] for field in fields
+                           if field in config['bill_to']]),
+            bill_to_email=config['bill_to'].get('email'),
+            bill=Bill(*[str(config['bill'][field]) for field in Bill._fields]),
+            work_done=tuple([item['work'] for item in config['work_done']]),
+            billables=tuple(billables),
+            currency_code=config['currency_code'],
+            currency_marker=config['currency_marker'],
+            home_currency=app_config['home_currency'],
+            tax_name=tax_name,
+            subtotal=subtotal,
+            tax=tax,
+            total=subtotal + tax,
+            color_light=Color.from_config(config['colors']['color_light']),
+            color_dark=Color.from_config(config['colors']['color_dark']),
+            sans_font=app_config['sans_font'],
+            serif_font=app_config['serif_font'],
+            fonts=tuple(fonts),
+            output_dir=app_config['output_dir'])
 
 
 class InvoiceUtils():
@@ -276,9 +166,26 @@ class InvoiceUtils():
         return work_days
 
     @staticmethod
-    def get_week_info(year, month, off):
+    def get_work_days(work_days, week_start, week_end, off, off_info):
+        '''given the number of weekdays from week_start to week_end,
+        return the number of those that are work days, either by
+        removing the days in the off list, or if off_info is a tuple
+        of holiday calendar and (year, month, off days mask) as from
+        HolidayCalendar.get_month_mask(), by counting them in the calendar'''
+        if off_info is None:
+            return InvoiceUtils.remove_off(work_days, week_start, week_end, off)
+        holidays, (year, month, off_mask) = off_info
+        return holidays.count_workdays(datetime.date(year, month, week_start),
+                                       datetime.date(year, month, week_end), (year, off_mask))
+
+    @staticmethod
+    def get_week_info(year, month, off, holidays=None):
         '''return a list of start and end days for each week, plus
-        the number of workdays (filtered for the off days list supplied)'''
+        the number of workdays (filtered for the off days list supplied,
+        and for the holidays in the calendar if one is supplied)'''
+        off_info = None
+        if holidays is not None:
+            off_info = (holidays, holidays.get_month_mask(year, month, off))
         week_info = []
         week_start_date = 1
         # find the day of the week of the 1st of the month and
@@ -294,7 +201,8 @@ class InvoiceUtils():
             work_days = 5
         else:
             work_days = week_difference
-        work_days = InvoiceUtils.remove_off(work_days, week_start_date, week_end_date, off)
+        work_days = InvoiceUtils.get_work_days(work_days, week_start_date, week_end_date,
+                                               off, off_info)
 
         while True:
             work_hours = work_days * 8
@@ -308,7 +216,26 @@ class InvoiceUtils():
             else:
                 week_end_date = month_end
                 work_days = month_end - week_start_date
-            work_days = InvoiceUtils.remove_off(work_days, week_start_date, week_end_date, off)
+            work_days = InvoiceUtils.get_work_days(work_days, week_start_date, week_end_date,
+                                                   off, off_info)
+        return week_info
+
+    @staticmethod
+    def get_week_hours(year, month, daily_hours):
+        '''return a list of start and end days for each week, plus
+        the number of days worked and the hours actually worked, as
+        recorded in the daily_hours dict of YYYY-MM-DD -> hours
+        (see Timesheet.get_daily_hours)'''
+        week_info = []
+        for week in InvoiceUtils.get_week_info(year, month, []):
+            work_days = 0
+            work_hours = decimal.Decimal(0)
+            for day in range(week[0], week[1] + 1):
+                hours = daily_hours.get("{y:04d}-{m:02d}-{d:02d}".format(y=year, m=month, d=day))
+                if hours:
+                    work_days = work_days + 1
+                    work_hours = work_hours + hours
+            week_info.append((week[0], week[1], work_days, work_hours))
         return week_info
 
     @staticmethod
@@ -330,20 +257,26 @@ class InvoiceUtils():
             FIELDS['billables']['week_of'] + ' {month} {start} - {end}'.format(
                 month=calendar.month_name[month], start=week_info[0], end=week_info[1]))
         billable['rate'] = str(rate)
-        billable['hours'] = str(week_info[3])
+        billable['hours'] = InvoiceUtils.format_hours(week_info[3])
         # printable format for the rate
         billable['rate'] = currency_marker + ' ' + billable['rate']
         # add the line item cost
-        cost = InvoiceUtils.convert_money(billable['rate']) * int(billable['hours'])
+        cost = InvoiceUtils.get_cost(InvoiceUtils.convert_money(billable['rate']), week_info[3])
         billable['cost'] = currency_marker + ' ' + InvoiceUtils.format_money(cost)
         return billable
 
     @staticmethod
-    def get_billables(values, billdate, currency_marker):
+    def get_billables(values, billdate, currency_marker, daily_hours=None, holidays=None):
         '''
         given a set of values for an invoice, and a billdate,
         generate a dict of billables from these values
         and return it
+
+        if daily hours from a timesheet are passed in and any of them
+        fall in the month being billed, the actual hours worked are
+        billed; otherwise 8 hours are billed for each work day, leaving
+        out the off days for the month and the days in the holiday
+        calendar, if one is passed in
         '''
         if 'off_days' in values[billdate]:
             off = values[billdate]['off_days']
@@ -352,8 +285,16 @@ class InvoiceUtils():
         year, month, _unused = billdate.split('-')
         year = int(year)
         month = int(month)
-        off = [day for day in off if InvoiceUtils.not_weekend(day, month, year)]
-        weeks = InvoiceUtils.get_week_info(year, month, off)
+        weeks = None
+        if daily_hours:
+            weeks = InvoiceUtils.get_week_hours(year, month, daily_hours)
+            if not [week for week in weeks if week[3] > 0]:
+                weeks = None
+        if weeks is None and holidays is not None:
+            weeks = InvoiceUtils.get_week_info(year, month, off, holidays)
+        elif weeks is None:
+            off = [day for day in off if InvoiceUtils.not_weekend(day, month, year)]
+            weeks = InvoiceUtils.get_week_info(year, month, off)
         billables = {'billables':
                      [InvoiceUtils.fillin_billable(
                          week, values[billdate]['rate'], month, currency_marker)
@@ -370,22 +311,45 @@ class InvoiceUtils():
             return '$'
         return config['currency_marker']
 
+    @staticmethod
+    def get_invoice_date(billdate):
+        '''
+        from the bill date, figure out the invoice date, which is
+        in the format "Monthname daynum, Year"
+        '''
+        year, month, last_day = billdate.split('-')
+        month = int(month)
+        month_name = calendar.month_name[month]
+        last_day = int(last_day)
+        return "{name} {day}, {year}".format(name=month_name, day=last_day, year=year)
+
+    @staticmethod
+    def get_invoice_number(billdate):
+        '''
+        from the bill date, figure out the invoice number, which is
+        in the format "MonthabbrevDaynumYear"
+        '''
+        year, month, last_day = billdate.split('-')
+        month = int(month)
+        month_name = calendar.month_name[month]
+        last_day = int(last_day)
+        return "{name}{day}{year}".format(name=month_name[0:3], day=last_day, year=year)
+
     @staticmethod
     def set_due_date(config):
         '''
         Determine the due date based on the Net 30|60|90|120|180 terms
         with default Net 30, and all other payment term strings causing
-        an error
+        an InvoiceError
         Return the new updated config
         '''
         if 'payment_terms' not in config['bill']:
             # default. FIXME document this.
             config['bill']['payment_terms'] = 'Net 30'
-        fields = config['bill']['payment_terms'].split()
-        if (fields[0] not in ['net', 'Net'] or not fields[1].isdigit() or
+        fields = str(config['bill']['payment_terms']).split()
+        if (len(fields) != 2 or fields[0] not in ['net', 'Net'] or
                 fields[1] not in ["30", "60", "90", "120", "180"]):
-            sys.stderr.write("Bad payment terms: " + config['bill']['payment_terms'] + "\n")
-            sys.exit(1)
+            raise InvoiceError("Bad payment terms: " + str(config['bill']['payment_terms']))
 
         config['bill']['due_date'] = InvoiceUtils.get_n_months_later(
             config['billdate'], int(fields[1]))
@@ -410,15 +374,19 @@ class InvoiceUtils():
 
         this lets us work with monetary values as ints; they can be
         formatted back to money for printing
-        '''
-        while not value[0].isdigit():
-            value = value[1:]
-        if not value:
-            return 0
 
-        if '.' in value:
-            base, decimal = value.split('.')
-            return int(base) * 100 + int(decimal[0]) * 10 + int(decimal[1])
+        raise InvoiceError if what is left isn't a whole number or one
+        with exactly two decimal places
+        '''
+        amount = value
+        while amount and not amount[0].isdigit():
+            amount = amount[1:]
+        base, point, cents = amount.partition('.')
+        if not base.isdigit() or (point and (len(cents) != 2 or not cents.isdigit())):
+            raise InvoiceError("Bad money value '" + value +
+                               "', must be a number with no decimals or exactly two")
+        if point:
+            return int(base) * 100 + int(cents)
         return int(base) * 100
 
     @staticmethod
@@ -428,12 +396,401 @@ class InvoiceUtils():
         suitable for printing
         '''
         base = int(value / 100)
-        decimal = value % 100
-        if decimal == 0:
-            padding = "0"
-        else:
-            padding = ""
-        return "{base}.{dec}{pad}".format(base=base, dec=decimal, pad=padding)
+        cents = value % 100
+        return "{base}.{cents:02d}".format(base=base, cents=cents)
+
+    @staticmethod
+    def get_cost(rate, hours):
+        '''
+        given a rate in cents (int) and a number of hours (int or Decimal,
+        possibly fractional), return the cost in cents, rounded to the
+        nearest cent
+        '''
+        cost = decimal.Decimal(rate) * decimal.Decimal(hours)
+        return int(cost.quantize(decimal.Decimal(1), rounding=decimal.ROUND_HALF_UP))
+
+    @staticmethod
+    def format_hours(hours):
+        '''
+        convert a number of hours (int or Decimal) to a string suitable
+        for printing, without trailing zeros after the decimal point
+        '''
+        return '{0:f}'.format(decimal.Decimal(hours).normalize())
+
+
+class HolidayCalendar():
+    '''
+    work days (Monday through Friday, less holidays) for each year,
+    kept as one bitset per year with bit n set if day n of the year
+    (counting from 0) is a work day, so that work days in any date
+    range can be counted with a mask and a popcount
+    '''
+    def __init__(self, holidays=None):
+        # year -> bitset of holidays
+        self.holidays = {}
+        # year -> bitset of work days, computed on first use
+        self.workdays = {}
+        for date in holidays or []:
+            self.add_holiday(date)
+
+    @staticmethod
+    def load(path):
+        '''
+        given the path to a yaml file of holidays, either a list of
+        dates or a dict of date -> holiday name, with dates in
+        YYYY-MM-DD format, return a calendar with those holidays
+        '''
+        import yaml
+        with open(path, "r") as fhandle:
+            contents = yaml.safe_load(fhandle)
+        if not contents:
+            contents = []
+        dates = []
+        for date in contents:
+            year, month, day = str(date).split('-')
+            dates.append(datetime.date(int(year), int(month), int(day)))
+        return HolidayCalendar(dates)
+
+    @staticmethod
+    def get_day_of_year(date):
+        '''return the day of the year of the date, counting from 0'''
+        return date.toordinal() - datetime.date(date.year, 1, 1).toordinal()
+
+    def add_holiday(self, date):
+        '''mark the date (datetime.date) as a holiday'''
+        self.holidays[date.year] = (self.holidays.get(date.year, 0) |
+                                    1 << HolidayCalendar.get_day_of_year(date))
+        self.workdays.pop(date.year, None)
+
+    def get_workdays(self, year):
+        '''return the bitset of work days for the year'''
+        if year not in self.workdays:
+            bits = 0
+            date = datetime.date(year, 1, 1)
+            for day in range(0, 366 if calendar.isleap(year) else 365):
+                if (date + datetime.timedelta(days=day)).weekday() < 5:
+                    bits = bits | 1 << day
+            self.workdays[year] = bits & ~self.holidays.get(year, 0)
+        return self.workdays[year]
+
+    def get_month_mask(self, year, month, off_days):
+        '''
+        given a list of off days for a month, return (year, month, mask)
+        where mask is the bitset of those days for the year; (year, mask)
+        is suitable for passing to count_workdays()
+        '''
+        first = HolidayCalendar.get_day_of_year(datetime.date(year, month, 1))
+        mask = 0
+        for day in off_days:
+            mask = mask | 1 << (first + day - 1)
+        return year, month, mask
+
+    def count_workdays(self, start, end, off_mask=None):
+        '''
+        return the number of work days from the start date through
+        the end date (datetime.date) inclusive, leaving out holidays and,
+        if off_mask is a (year, bitset) pair, the days in the bitset for
+        that year
+        '''
+        count = 0
+        for year in range(start.year, end.year + 1):
+            first = 0
+            if year == start.year:
+                first = HolidayCalendar.get_day_of_year(start)
+            last = HolidayCalendar.get_day_of_year(datetime.date(year, 12, 31))
+            if year == end.year:
+                last = HolidayCalendar.get_day_of_year(end)
+            if last < first:
+                continue
+            bits = self.get_workdays(year)
+            if off_mask is not None and off_mask[0] == year:
+                bits = bits & ~off_mask[1]
+            bits = (bits >> first) & ((1 << (last - first + 1)) - 1)
+            count = count + bin(bits).count('1')
+        return count
+
+
+class FxRates():
+    '''
+    exchange rates into the home currency, read once from a csv file
+    with a header row and the columns 'date' (YYYY-MM-DD, the date from
+    which the rate applies), 'currency' (e.g. EUR) and 'rate' (units of
+    home currency per unit of that currency)
+    '''
+    def __init__(self):
+        # currency -> (sorted list of dates, list of rates for those dates)
+        self.rates = {}
+        # (currency, date) -> rate, for rates already looked up
+        self.lookups = {}
+
+    @staticmethod
+    def load(path):
+        '''
+        given the path to a csv file of exchange rates, return an FxRates
+        object with those rates, or raise InvoiceError naming the line
+        of the file that is bad
+        '''
+        by_currency = {}
+        with open(path, "r", newline='') as fhandle:
+            reader = csv.DictReader(fhandle)
+            try:
+                if not set(['date', 'currency', 'rate']).issubset(reader.fieldnames or []):
+                    raise InvoiceError("Exchange rates " + path +
+                                       " must have 'date', 'currency' and 'rate' columns")
+                for row in reader:
+                    by_currency.setdefault(row['currency'].strip(), []).append(
+                        FxRates.get_row(row, path, reader.line_num))
+            except csv.Error as err:
+                raise InvoiceError("Exchange rates " + path + " line " + str(reader.line_num) +
+                                   ": " + str(err)) from err
+        fxrates = FxRates()
+        for currency, entries in by_currency.items():
+            entries.sort()
+            fxrates.rates[currency] = ([entry[0] for entry in entries],
+                                       [entry[1] for entry in entries])
+        return fxrates
+
+    @staticmethod
+    def get_row(row, path, line_num):
+        '''
+        check a row of the exchange rates file and return its date and rate
+        as a YYYY-MM-DD string and a Decimal, or raise InvoiceError
+        '''
+        error = "Exchange rates " + path + " line " + str(line_num) + ": "
+        if None in row.values():
+            raise InvoiceError(error + "must have 'date', 'currency' and 'rate' columns")
+        date = row['date'].strip()
+        if not is_date(date):
+            raise InvoiceError(error + "date '" + date + "' is not in YYYY-MM-DD format")
+        try:
+            rate = decimal.Decimal(row['rate'].strip())
+        except decimal.InvalidOperation:
+            rate = None
+        if rate is None or not rate.is_finite() or rate <= 0:
+            raise InvoiceError(error + "rate '" + row['rate'] + "' is not a positive number")
+        return date, rate
+
+    def get_rate(self, currency, home_currency, date):
+        '''
+        return the rate for converting the currency into the home currency
+        on the given date (YYYY-MM-DD), i.e. the most recent rate on or
+        before that date
+        '''
+        if currency == home_currency:
+            return decimal.Decimal(1)
+        if (currency, date) not in self.lookups:
+            if currency not in self.rates:
+                raise ValueError("No exchange rates for currency " + currency)
+            dates, rates = self.rates[currency]
+            index = bisect.bisect_right(dates, date)
+            if not index:
+                raise ValueError("No exchange rate for currency " + currency +
+                                 " on or before " + date)
+            self.lookups[(currency, date)] = rates[index - 1]
+        return self.lookups[(currency, date)]
+
+    def convert(self, value, currency, home_currency, date):
+        '''
+        convert a value in cents (int) in the given currency to cents in
+        the home currency, using the rate on the given date (YYYY-MM-DD),
+        rounded to the nearest cent
+        '''
+        converted = decimal.Decimal(value) * self.get_rate(currency, home_currency, date)
+        return int(converted.quantize(decimal.Decimal(1), rounding=decimal.ROUND_HALF_UP))
+
+
+class Timesheet():
+    '''
+    read hours worked from a time tracking export, with one row per
+    person per day, in either csv format (with a header row naming
+    at least the 'date' and 'hours' columns) or jsonl format (one
+    json object per line with at least 'date' and 'hours' keys)
+    '''
+    @staticmethod
+    def read_rows(path):
+        '''
+        given the path to a timesheet, yield (date, hours) for each row
+        in the file, as strings in YYYY-MM-DD format and Decimals; rows
+        are read one at a time so that huge exports can be handled
+
+        raise InvoiceError, naming the line, for a row that can't be read
+        '''
+        if os.path.splitext(path)[1].lower() in ['.jsonl', '.ndjson', '.json']:
+            with open(path, "r") as fhandle:
+                for line_num, line in enumerate(fhandle, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        row = json.loads(line)
+                        date, hours = row['date'], row['hours']
+                    except (KeyError, TypeError, ValueError) as err:
+                        raise InvoiceError(Timesheet.get_row_error(
+                            path, line_num, "needs a json object with 'date' and 'hours'",
+                            err)) from err
+                    yield Timesheet.get_row(str(date), str(hours), path, line_num)
+            return
+
+        with open(path, "r", newline='') as fhandle:
+            reader = csv.reader(fhandle)
+            header = [field.strip().lower() for field in next(reader, [])]
+            if 'date' not in header or 'hours' not in header:
+                raise InvoiceError("Timesheet " + path + " must have 'date' and 'hours' columns")
+            date_col = header.index('date')
+            hours_col = header.index('hours')
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) <= max(date_col, hours_col):
+                    raise InvoiceError(Timesheet.get_row_error(
+                        path, reader.line_num, "is missing the 'date' or 'hours' column"))
+                yield Timesheet.get_row(row[date_col].strip(), row[hours_col].strip(),
+                                        path, reader.line_num)
+
+    @staticmethod
+    def get_row(date, hours, path, line_num):
+        '''
+        check the date and hours from a row of the timesheet and return
+        them as a YYYY-MM-DD string and a Decimal, or raise InvoiceError;
+        days are matched up with the bill period by that string, so a row
+        with a date in any other format would silently not count
+        '''
+        if not is_date(date):
+            raise InvoiceError(Timesheet.get_row_error(
+                path, line_num, "date '" + date + "' is not in YYYY-MM-DD format"))
+        try:
+            return date, decimal.Decimal(hours)
+        except decimal.InvalidOperation as err:
+            raise InvoiceError(Timesheet.get_row_error(
+                path, line_num, "hours '" + hours + "' is not a number")) from err
+
+    @staticmethod
+    def get_row_error(path, line_num, problem, err=None):
+        '''return a message about a bad row in the timesheet'''
+        message = "Timesheet " + path + " line " + str(line_num) + ": " + problem
+        if err is not None:
+            message = message + " (" + type(err).__name__ + ": " + str(err) + ")"
+        return message
+
+    @staticmethod
+    def get_daily_hours(path):
+        '''
+        given the path to a timesheet, return a dict of date (YYYY-MM-DD)
+        -> total hours worked on that day by everyone; memory use depends
+        only on the number of distinct days, not on the number of rows
+        '''
+        daily_hours = {}
+        for date, hours in Timesheet.read_rows(path):
+            daily_hours[date] = daily_hours.get(date, 0) + hours
+        return daily_hours
+
+
+class ValuesIndex():
+    '''
+    index of the entries in a values file by billdate, giving the byte
+    range of each one so that a single entry can be read and parsed
+    without the rest of the file
+
+    the index is kept in a sidecar file next to the values file, and
+    rebuilt when the values file's size or modification time changes
+    '''
+    suffix = '.index'
+
+    @staticmethod
+    def get_file_id(valuesfile):
+        '''return what identifies this version of the values file'''
+        stat = os.stat(valuesfile)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @staticmethod
+    def build(valuesfile):
+        '''
+        scan the values file for top level keys and return a dict of
+        billdate -> [start, end] byte offsets of its entry, or None if
+        the file isn't a plain block mapping that we know how to index
+        '''
+        import yaml
+        entries = {}
+        billdate = None
+        start = 0
+        offset = 0
+        with open(valuesfile, "rb") as fhandle:
+            for line in fhandle:
+                line_start = offset
+                offset = offset + len(line)
+                if line[:1] in (b' ', b'\t', b'#') or not line.strip():
+                    continue
+                if line.rstrip() == b'---' and billdate is None:
+                    continue
+                key, sep, _unused = line.partition(b':')
+                try:
+                    key = yaml.safe_load(key.decode('utf-8'))
+                except (UnicodeDecodeError, yaml.YAMLError):
+                    return None
+                if not sep or not isinstance(key, str):
+                    return None
+                if billdate is not None:
+                    entries[billdate] = [start, line_start]
+                billdate = key
+                start = line_start
+        if billdate is not None:
+            entries[billdate] = [start, offset]
+        return entries
+
+    @staticmethod
+    def load(valuesfile):
+        '''
+        return the index for the values file, from the sidecar if it is
+        current and otherwise built and saved to the sidecar, if we can
+        '''
+        file_id = ValuesIndex.get_file_id(valuesfile)
+        sidecar = valuesfile + ValuesIndex.suffix
+        try:
+            with open(sidecar, "r") as fhandle:
+                index = json.load(fhandle)
+            if index.get('file') == file_id:
+                return index['entries']
+        except (OSError, ValueError):
+            pass
+
+        entries = ValuesIndex.build(valuesfile)
+        try:
+            InvoiceWriter.write_atomic(sidecar, json.dumps(
+                {'file': file_id, 'entries': entries}).encode('utf-8'))
+        except OSError:
+            # a read-only directory just means no index next time either
+            pass
+        return entries
+
+    @staticmethod
+    def get_values(valuesfile, billdate):
+        '''
+        return the values for just the entry with the given billdate,
+        in the same form as loading the whole file would, reading
+        only that entry if the file can be indexed
+        '''
+        import yaml
+        entries = ValuesIndex.load(valuesfile)
+        if entries is not None:
+            if billdate not in entries:
+                raise InvoiceError("No entry for " + billdate + " in " + valuesfile)
+            start, end = entries[billdate]
+            with open(valuesfile, "rb") as fhandle:
+                fhandle.seek(start)
+                text = fhandle.read(end - start).decode('utf-8')
+            try:
+                values = yaml.safe_load(text)
+            except yaml.YAMLError:
+                # most likely an alias to an anchor in another entry,
+                # which only the whole file has
+                values = None
+            if isinstance(values, dict) and list(values) == [billdate]:
+                return values
+
+        with open(valuesfile, "r") as fhandle:
+            values = yaml.safe_load(fhandle.read())
+        if billdate not in values:
+            raise InvoiceError("No entry for " + billdate + " in " + valuesfile)
+        return {billdate: values[billdate]}
 
 
 class InvoiceDraw():
@@ -513,10 +870,7 @@ class InvoiceDraw():
         self.pdf.set_y(ypos)
 
         # the next column, plus border around both
-        fields = ['email', 'name', 'street', 'city_state_zip', 'country']
-        values = [self.pdf.config['bill_to'][field] for field in fields
-                  if field in self.pdf.config['bill_to']]
-        self.draw_unframed_list(None, values, 20, True)
+        self.draw_unframed_list(None, self.pdf.invoice.bill_to, 20, True)
 
     def draw_work_table(self):
         '''
@@ -524,8 +878,7 @@ class InvoiceDraw():
         '''
         self.pdf.ln(20)
 
-        values = [item['work'] for item in self.pdf.config['work_done']]
-        self.draw_unframed_list("Work Details", values, 0, False)
+        self.draw_unframed_list("Work Details", self.pdf.invoice.work_done, 0, False)
 
     def set_table_header_colors_font(self):
         '''
@@ -568,13 +921,9 @@ class InvoiceDraw():
         the table will be the width of the page (minus margins)
 
         args:
-            pfd: PDF object
-            table_content: list of dicts with content field names and content
-            table_info: dict with two entries:
+            table_content: list of rows, each a sequence of strings, one per header
+            table_info: dict with one entry:
             headers: list of headers to go in the header row of the table
-            content_keys: list of keys from the table_content dicts, one key per
-                header, so we know which elements in table content correspond
-                to which headers and in which order
             align: right align the text (default) or some other alignment (e.g. "L")
         '''
         self.set_table_header_colors_font()
@@ -586,16 +935,18 @@ class InvoiceDraw():
         widths = self.get_widths(table_info['headers'])
 
         # put the headers
-        for idx, header in enumerate(table_info['headers']):
-            self.pdf.header_cell(widths[idx], int(self.pdf.font_size_pt / 2), header)
+        def draw_headers():
+            for idx, header in enumerate(table_info['headers']):
+                self.pdf.header_cell(widths[idx], int(self.pdf.font_size_pt / 2), header)
+        self.pdf.static_fragment(('table_headers',) + tuple(table_info['headers']),
+                                 draw_headers, positioned=True)
 
         self.pdf.ln(5)
         self.set_table_content_colors_font()
 
         # put the content
         for row in table_content:
-            for idx, name in enumerate(table_info['content_keys']):
-                value = row[name]
+            for idx, value in enumerate(row):
                 if align == "L":
                     self.pdf.content_cell_left(widths[idx], int(self.pdf.font_size_pt / 2), value)
                 else:
@@ -609,9 +960,8 @@ class InvoiceDraw():
         '''
         headers = [FIELDS['bill']['dept'], FIELDS['bill']['currency'],
                    FIELDS['bill']['terms'], FIELDS['bill']['due']]
-        content_keys = ['department', 'currency', 'payment_terms', 'due_date']
-        table_info = {'headers': headers, 'content_keys': content_keys}
-        table_content = [self.pdf.config['bill']]
+        table_info = {'headers': headers}
+        table_content = [self.pdf.invoice.bill]
         self.draw_filled_table(table_content, table_info, align="L")
 
     def draw_blanks(self, widths):
@@ -621,23 +971,17 @@ class InvoiceDraw():
         '''
         # choose the first billable item, this tells us how many cells
         # we had, the rightmost two will be filled, blank the rest
-        empty = len(self.pdf.config['billables'][0]) - 2
+        empty = len(self.pdf.invoice.billables[0]) - 2
         for i in range(0, empty):
             self.pdf.blank_cell(widths[i], int(self.pdf.font_size_pt / 2))
 
-    def get_tax(self, subtotal):
+    def get_tax(self):
         '''return tax based on default percentage in config'''
-        tax = 0
-        if self.pdf.config['tax_details'] is not None:
-            tax = int(subtotal * self.pdf.config['tax_details']['default_percentage'] / 100)
-        return tax
+        return self.pdf.invoice.tax
 
     def get_subtotal(self):
-        '''compute and return the subtotal'''
-        subtotal = 0
-        for billable in self.pdf.config['billables']:
-            subtotal = subtotal + InvoiceUtils.convert_money(billable['cost'])
-        return subtotal
+        '''return the subtotal'''
+        return self.pdf.invoice.subtotal
 
     def draw_subtotal(self, subtotal, widths, xpos):
         '''display the subtotal line'''
@@ -647,7 +991,7 @@ class InvoiceDraw():
         self.pdf.serif(8)
         self.pdf.set_x(xpos)
 
-        subtotal_text = (self.pdf.config['currency_marker'] + ' ' +
+        subtotal_text = (self.pdf.invoice.currency_marker + ' ' +
                          InvoiceUtils.format_money(subtotal))
         self.pdf.content_cell(widths[0], int(self.pdf.font_size_pt / 2),
                               FIELDS['totals']['subtotal'])
@@ -660,14 +1004,10 @@ class InvoiceDraw():
         self.pdf.serif(8)
         self.pdf.set_x(xpos)
 
-        tax_name = FIELDS['totals']['tax']
-        if ('tax_details' in self.pdf.config and 'tax_name' in self.pdf.config['tax_details'] and
-                self.pdf.config['tax_details']['tax_name']):
-            tax_name = self.pdf.config['tax_details']['tax_name']
-
-        tax_text = self.pdf.config['currency_marker'] + " " + InvoiceUtils.format_money(tax)
+        tax_text = self.pdf.invoice.currency_marker + " " + InvoiceUtils.format_money(tax)
 
-        self.pdf.content_cell(widths[0], int(self.pdf.font_size_pt / 2), tax_name)
+        self.pdf.content_cell(widths[0], int(self.pdf.font_size_pt / 2),
+                              self.pdf.invoice.tax_name)
         self.pdf.content_cell(widths[1], int(self.pdf.font_size_pt / 2), tax_text)
 
     def set_total_colors_font(self):
@@ -686,7 +1026,7 @@ class InvoiceDraw():
         y_pos = self.pdf.get_y()
 
         # write the currency marker plus total
-        total_text = self.pdf.config['currency_marker'] + ' ' + InvoiceUtils.format_money(total)
+        total_text = self.pdf.invoice.currency_marker + ' ' + InvoiceUtils.format_money(total)
         self.pdf.content_cell(widths[0], int(self.pdf.font_size_pt / 2), FIELDS['totals']['total'])
         self.pdf.content_cell(widths[1], int(self.pdf.font_size_pt / 2), total_text)
 
@@ -701,9 +1041,12 @@ class InvoiceDraw():
         '''
         headers = [FIELDS['billables']['week'], FIELDS['billables']['hours'],
                    FIELDS['billables']['rate'], FIELDS['billables']['total']]
-        content_keys = ["description", "hours", "rate", "cost"]
-        table_info = {'headers': headers, 'content_keys': content_keys}
-        table_content = self.pdf.config['billables']
+        table_info = {'headers': headers}
+        marker = self.pdf.invoice.currency_marker + ' '
+        table_content = [(billable.description, InvoiceUtils.format_hours(billable.hours),
+                          marker + InvoiceUtils.format_money(billable.rate),
+                          marker + InvoiceUtils.format_money(billable.cost))
+                         for billable in self.pdf.invoice.billables]
         self.draw_filled_table(table_content, table_info, None)
 
     def get_totals_taxes_widths(self):
@@ -714,7 +1057,7 @@ class InvoiceDraw():
         '''
         self.set_total_colors_font()
         # make more than this in a week? get yer own invoice generator!
-        max_total_text = self.pdf.config['currency_marker'] + ' ' + "999999.99"
+        max_total_text = self.pdf.invoice.currency_marker + ' ' + "999999.99"
         widths = [self.pdf.get_string_width(FIELDS['totals']['total']),
                   self.pdf.get_string_width(max_total_text)]
         # add a little padding
@@ -729,31 +1072,39 @@ class InvoiceDraw():
         # must add in the left margin to properly place x
         xpos = self.pdf.page_width - sum(widths) + self.pdf.margin + 2
 
-        subtotal = self.get_subtotal()
-        self.draw_subtotal(subtotal, widths, xpos)
-
-        tax = self.get_tax(subtotal)
-        self.draw_tax(tax, widths, xpos)
-
-        total = subtotal + tax
-        self.draw_total(total, widths, xpos)
+        self.draw_subtotal(self.get_subtotal(), widths, xpos)
+        self.draw_tax(self.get_tax(), widths, xpos)
+        self.draw_total(self.pdf.invoice.total, widths, xpos)
 
 
 class InvoiceConfig():
     '''manage invoice settings'''
     @staticmethod
-    def get_yaml_config(template, valuesfile):
+    def get_yaml_config(template, valuesfile, timesheet=None, holidays=None, failures=None,
+                        billdate=None):
         '''
         given template and a tiny set of values for one or
-        more invoices,
+        more invoices, and optionally a timesheet with the hours
+        actually worked and a file of holidays,
         generate a yaml config with settings for each invoice
         and return it
+
+        if a billdate is passed in, only the values for that invoice
+        are read, and its config is the only one returned
+
+        if a list of failures is passed in, entries whose values are
+        bad are skipped and a description of each is added to the list;
+        otherwise the first bad entry raises an exception
         '''
+        import yaml
         with open(template, "r") as fhandle:
             text = fhandle.read()
-        with open(valuesfile, "r") as fhandle:
-            contents = fhandle.read()
-            values = yaml.safe_load(contents)
+        if billdate:
+            values = ValuesIndex.get_values(valuesfile, billdate)
+        else:
+            with open(valuesfile, "r") as fhandle:
+                contents = fhandle.read()
+                values = yaml.safe_load(contents)
 
         config = []
 
@@ -767,47 +1118,97 @@ class InvoiceConfig():
             }
         currency_marker = InvoiceUtils.get_currency_marker(yaml.safe_load(fake_completed_text))
 
-        for billdate in values:
-            work = {'work_done': values[billdate]['work_done']}
+        daily_hours = None
+        if timesheet:
+            daily_hours = Timesheet.get_daily_hours(timesheet)
+        if holidays:
+            holidays = HolidayCalendar.load(holidays)
+
+        for entry_billdate in values:
+            try:
+                config.append(InvoiceConfig.get_entry_config(
+                    text, values, entry_billdate, currency_marker, daily_hours, holidays))
+            except Exception as err:  # pylint: disable=broad-except
+                # a bad entry can break in all sorts of ways; in keep-going
+                # mode none of them should stop the rest of the batch
+                if failures is None:
+                    raise
+                failures.append(get_failure(entry_billdate, 'config', err))
 
-            billables = InvoiceUtils.get_billables(values, billdate, currency_marker)
+        return config
 
-            completed_text = text % {
-                "BILLDATE": billdate,
-                "WORK": yaml.dump(work),
-                "BILLABLES": yaml.dump(billables)
-            }
-            config.append(yaml.safe_load(completed_text))
+    @staticmethod
+    def get_entry_config(text, values, billdate, currency_marker, daily_hours, holidays):
+        '''
+        given the template text, the values for all invoices, and the
+        billdate of one of them, generate and return the yaml config
+        for that invoice
+        '''
+        import yaml
+        work = {'work_done': values[billdate]['work_done']}
 
+        # entries may be billed in a currency other than the template's
+        marker = values[billdate].get('currency_marker', currency_marker)
+        billables = InvoiceUtils.get_billables(values, billdate, marker,
+                                               daily_hours, holidays)
+
+        completed_text = text % {
+            "BILLDATE": billdate,
+            "WORK": yaml.dump(work),
+            "BILLABLES": yaml.dump(billables)
+        }
+        entry = yaml.safe_load(completed_text)
+        return InvoiceConfig.set_entry_currency(entry, values[billdate])
+
+    @staticmethod
+    def set_entry_currency(config, entry_values):
+        '''
+        override the currency code, marker and name from the template
+        with those from the values for the invoice, if any
+        '''
+        if 'currency_code' in entry_values:
+            config['currency_code'] = entry_values['currency_code']
+        if 'currency_marker' in entry_values:
+            config['currency_marker'] = entry_values['currency_marker']
+        if 'currency' in entry_values and 'bill' in config:
+            config['bill']['currency'] = entry_values['currency']
         return config
 
     @staticmethod
-    def validate_config(config):
-        '''check some fields in the yaml config'''
+    def validate_config(config, errors=None):
+        '''
+        check some fields in the yaml config; problems are written
+        to stderr and added to the list of errors if one is passed in
+        '''
         required_sections = ['business', 'bill_to', 'bill', 'work_done', 'billables']
         for section in required_sections:
             if section not in config:
-                sys.stderr.write("Config is missing mandatory stanza " + section + "\n")
+                complain("Config is missing mandatory stanza " + section, errors)
                 return False
 
         settings = ['name', 'person', 'address']
-        okay = check_missing_settings('business', settings, config)
+        okay = check_missing_settings('business', settings, config, errors)
         settings = ['email', 'name', 'street', 'city_state_zip', 'country']
-        result = check_missing_settings('bill_to', settings, config)
+        result = check_missing_settings('bill_to', settings, config, errors)
         okay = okay and result
         settings = ['department', 'currency', 'payment_terms', 'due_date']
-        result = check_missing_settings('bill', settings, config)
+        result = check_missing_settings('bill', settings, config, errors)
         okay = okay and result
         if not okay:
             return False
+        if not config['billables']:
+            complain("Config has no billable items", errors)
+            return False
         settings = ['description', 'hours', 'rate']
         for item in config['billables']:
-            result = check_missing_settings(None, settings, item)
+            result = check_missing_settings(None, settings, item, errors)
             okay = okay and result
+        if not okay:
+            return False
 
         if ('image_file' in config['business'] and
                 not os.path.exists(config['business']['image_file'])):
-            sys.stderr.write("No such image file " + config['business']['image_file'] + "\n")
+            complain("No such image file " + config['business']['image_file'], errors)
             return False
         return True
 
@@ -827,6 +1228,10 @@ class InvoiceConfig():
 
         if 'app_config' not in config:
             config['app_config'] = {}
+        if 'home_currency' not in config['app_config']:
+            config['app_config']['home_currency'] = 'USD'
+        if 'currency_code' not in config:
+            config['currency_code'] = config['app_config']['home_currency']
         if 'output_dir' not in config['app_config']:
             config['app_config']['output_dir'] = './billed'
         if 'sans_font' not in config['app_config']:
@@ -854,6 +1259,10 @@ def usage(message=None):
         sys.stderr.write("\n")
     usage_message = """
 Usage: python3 generate_pdf.py --values <path> --template <path>
+                 [--timesheet <path>] [--holidays <path>] [--fxrates <path>]
+                 [--billdate <YYYY-MM-DD>] [--fsync] [--keep-going [--report <path>]]
+                 [--archive <path>] [--mail <path>] [--incremental] [--skeleton]
+                 [--stats]
 
 This script generates an invoice in pdf format based on the values
 and template specified.
@@ -863,6 +1272,49 @@ default value if omitted is Net 30
 
 --values     (-v):  path to yaml file with the values to shove into the template
 --template   (-t):  path to template file
+--timesheet  (-s):  path to csv or jsonl file with one row per person per day,
+                    with at least 'date' (YYYY-MM-DD) and 'hours' fields;
+                    if given, the hours actually worked are billed for each
+                    month with entries in the file, instead of 8 hours for
+                    each work day
+--holidays   (-o):  path to yaml file with a list of holidays in YYYY-MM-DD
+                    format (or a dict of such dates to holiday names); these
+                    are not billed, in addition to the off days for each month
+--fxrates    (-x):  path to csv file with 'date', 'currency' and 'rate' columns,
+                    giving the rate from each currency into the home currency
+                    (app_config:home_currency in the template, default USD)
+                    from each date onward; if given, the total of each invoice
+                    and of all invoices is reported in the home currency
+--billdate   (-b):  generate only the invoice with this bill date from the values
+                    file; only that entry is read, using an index of the file
+                    kept alongside it in <values path>.index
+--fsync      (-f):  sync invoices to disk before renaming them into place,
+                    in batches, so that they survive a power failure
+--keep-going (-k):  if an invoice can't be generated, go on with the rest,
+                    then write a json report of the failures and exit with
+                    an error
+--report     (-r):  path to the file for the json report of failures;
+                    default is to write it to stdout
+--archive    (-a):  write all the invoices into this tar or zip archive instead
+                    of one file each, along with a manifest.csv listing each
+                    invoice's number, bill date, total and offset in the
+                    archive; the name must end in .tar, .tar.gz, .tgz,
+                    .tar.bz2, .tar.xz or .zip, which sets the compression
+--mail       (-m):  path to yaml file with smtp settings; if given, each invoice
+                    is emailed to its bill_to email address once rendered.
+                    'host' and 'from' must be set; 'port', 'security' (none,
+                    starttls or ssl), 'username', 'password', 'connections'
+                    (default 2), 'retries' (default 3), 'backoff' (seconds,
+                    default 1), 'subject' and 'body' are optional
+--incremental (-i): write each page of an invoice out as soon as it is drawn,
+                    rather than keeping the whole invoice in memory until it
+                    is done; can't be used with --archive or --mail
+--skeleton   (-c):  lay out the parts of the page that are the same for all
+                    invoices from the template (logo, labels, table headers
+                    and so on) once, and reuse them for the rest of the run
+--stats      (-S):  when done, write the number of pages drawn, the size of
+                    their content and the redundant graphics state changes
+                    dropped from it to stderr
 --help       (-h):  display this help message
 """
     sys.stderr.write(usage_message)
@@ -879,72 +1331,625 @@ def is_date(maybedate):
             return False
     if len(fields[0]) != 4 or len(fields[1]) != 2 or len(fields[2]) != 2:
         return False
-    if fields[1] < 1 or fields[1] > 12 or fields[2] < 1 or fields[1] > 31:
+    try:
+        datetime.date(int(fields[0]), int(fields[1]), int(fields[2]))
+    except ValueError:
         return False
     return True
 
 
 def get_args():
-    '''get and validate command-line args'''
-    template = None
-    valuesfile = None
+    '''get and validate command-line args, return them in a dict'''
+    args = {'template': None, 'values': None, 'timesheet': None, 'holidays': None,
+            'fxrates': None, 'fsync': False, 'keep_going': False, 'report': None,
+            'skeleton': False, 'stats': False, 'billdate': None, 'archive': None,
+            'mail': None, 'incremental': False}
     try:
         (options, remainder) = getopt.gnu_getopt(
-            sys.argv[1:], "t:v:h",
-            ["template=", "values=", "help"])
+            sys.argv[1:], "t:v:s:o:x:b:fkr:a:m:icSh",
+            ["template=", "values=", "timesheet=", "holidays=", "fxrates=", "billdate=", "fsync",
+             "keep-going", "report=", "archive=", "mail=", "incremental", "skeleton", "stats",
+             "help"])
     except getopt.GetoptError as err:
         usage("Unknown option specified: " + str(err))
 
     for (opt, val) in options:
         if opt in ["-t", "--template"]:
-            template = val
+            args['template'] = val
         elif opt in ["-v", "--values"]:
-            valuesfile = val
+            args['values'] = val
+        elif opt in ["-s", "--timesheet"]:
+            args['timesheet'] = val
+        elif opt in ["-o", "--holidays"]:
+            args['holidays'] = val
+        elif opt in ["-x", "--fxrates"]:
+            args['fxrates'] = val
+        elif opt in ["-b", "--billdate"]:
+            args['billdate'] = val
+        elif opt in ["-f", "--fsync"]:
+            args['fsync'] = True
+        elif opt in ["-k", "--keep-going"]:
+            args['keep_going'] = True
+        elif opt in ["-r", "--report"]:
+            args['report'] = val
+        elif opt in ["-a", "--archive"]:
+            args['archive'] = val
+        elif opt in ["-m", "--mail"]:
+            args['mail'] = val
+        elif opt in ["-i", "--incremental"]:
+            args['incremental'] = True
+        elif opt in ["-c", "--skeleton"]:
+            args['skeleton'] = True
+        elif opt in ["-S", "--stats"]:
+            args['stats'] = True
         elif opt in ["-h", "--help"]:
             usage("Help for this script")
 
-    if not template or not valuesfile:
+    if not args['template'] or not args['values']:
         usage("One of the mandatory arguments 'template' or 'values' was not specified")
 
+    if args['billdate'] and not is_date(args['billdate']):
+        usage("The 'billdate' option must be a date in YYYY-MM-DD format")
+
+    if args['archive'] and not ArchiveWriter.get_format(args['archive']):
+        usage("The 'archive' option must be a path ending in .tar, .tar.gz, .tgz, "
+              ".tar.bz2, .tar.xz or .zip")
+
+    if args['mail']:
+        try:
+            args['mail'] = InvoiceMailer.load_settings(args['mail'])
+        except (OSError, ValueError, TypeError) as err:
+            usage("Bad mail settings: " + str(err))
+
+    if args['incremental'] and (args['archive'] or args['mail']):
+        usage("The 'incremental' option can't be used with 'archive' or 'mail'")
+
+    if args['report'] and not args['keep_going']:
+        usage("The 'report' option may only be used with 'keep-going'")
+
     if remainder:
         usage("Unknown option(s) specified: %s" % remainder[0])
 
-    if not os.path.exists(template):
-        usage("No such file: " + template)
-    if not os.path.exists(valuesfile):
-        usage("No such file: " + valuesfile)
+    for path in [args['template'], args['values'], args['timesheet'], args['holidays'],
+                 args['fxrates']]:
+        if path and not os.path.exists(path):
+            usage("No such file: " + path)
 
-    return template, valuesfile
+    if args['fxrates']:
+        # read now, so that a bad rates file is found before any invoices go out
+        try:
+            args['fxrates'] = FxRates.load(args['fxrates'])
+        except (OSError, ValueError, InvoiceError) as err:
+            usage("Bad exchange rates: " + str(err))
 
+    return args
 
-def check_missing_settings(stanza, settings, config):
+
+def complain(message, errors=None):
+    '''
+    write the message to stderr, and add it to the list
+    of errors if one is passed in
+    '''
+    sys.stderr.write(message + "\n")
+    if errors is not None:
+        errors.append(message)
+
+
+def check_missing_settings(stanza, settings, config, errors=None):
     '''whine if any of the settings is missing from the stanza'''
     if stanza:
         for setting in settings:
             if setting not in config[stanza]:
-                sys.stderr.write("Config ' + stanza + 'stanza is missing mandatory setting "
-                                 + setting + "\n")
+                complain("Config " + stanza + " stanza is missing mandatory setting "
+                         + setting, errors)
                 return False
         return True
 
     for setting in settings:
         if setting not in config:
-            sys.stderr.write("Config entry is missing mandatory setting "
-                             + setting + "\n")
+            complain("Config entry is missing mandatory setting " + setting, errors)
             return False
     return True
 
 
-def render_pdf(config):
+class InvoiceWriter():
     '''
-    given a yaml config with all information for them
-    invoice, draw all the tables and other entries and
-    write out the pdf
+    write rendered invoices out on a background thread, so that
+    rendering of the next invoice overlaps with writing the last one;
+    each invoice is written to a temporary file in the output directory
+    and renamed into place, so that a crash never leaves a truncated
+    invoice and parallel runs never write into each other's files
     '''
+    # permissions for new files per the umask, as open() would give them;
+    # temporary files are created readable by the owner only
+    file_mode = None
+
+    def __init__(self, fsync=False, batch_size=16, queue_size=8):
+        self.fsync = fsync
+        self.batch_size = batch_size
+        # (temp path, final path, Invoice) of files waiting to be synced and renamed
+        self.pending = []
+        self.errors = []
+        # bounded so that rendering can't get arbitrarily far ahead of the disk
+        self.queue = queue.Queue(maxsize=queue_size)
+        InvoiceWriter.set_file_mode()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
-    # default: A4, portrait, all units are in milimeters except for
-    # font sizes, which are in points
-    pdf = PDF(config)
+    @staticmethod
+    def set_file_mode():
+        '''
+        work out the permissions for new files, if we haven't yet; the
+        umask can only be read by setting it, which affects all threads,
+        so this has to happen before the writer thread is started
+        '''
+        if InvoiceWriter.file_mode is None:
+            umask = os.umask(0o22)
+            os.umask(umask)
+            InvoiceWriter.file_mode = 0o666 & ~umask
+
+    @staticmethod
+    def write_temp(path, data):
+        '''
+        write the data (bytes) to a new temporary file in the same
+        directory as path, and return the name of the temporary file
+        '''
+        import tempfile
+        InvoiceWriter.set_file_mode()
+        dirname, basename = os.path.split(path)
+        fdesc, temp_path = tempfile.mkstemp(prefix='.' + basename + '.', suffix='.tmp',
+                                            dir=dirname or '.')
+        try:
+            os.fchmod(fdesc, InvoiceWriter.file_mode)
+            with os.fdopen(fdesc, 'wb') as fhandle:
+                fhandle.write(data)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+        return temp_path
+
+    @staticmethod
+    def write_atomic(path, data):
+        '''write the data (bytes) to path via a temporary file and rename'''
+        os.replace(InvoiceWriter.write_temp(path, data), path)
+
+    def submit(self, path, data, invoice=None):
+        '''
+        queue the data (bytes) to be written to path, waiting
+        if the queue is full; invoice is the Invoice the data
+        was rendered from, for writers that keep track of them
+        '''
+        self.queue.put((path, data, invoice, None))
+
+    def submit_written(self, temp_path, path, invoice=None):
+        '''
+        queue a temporary file that has already been written out to be
+        renamed into place as path, waiting if the queue is full
+        '''
+        self.queue.put((path, None, invoice, temp_path))
+
+    def close(self):
+        '''
+        wait for all queued invoices to be written, and return a list of
+        (path, list of Invoices lost, error message) for any files that
+        could not be; the list is empty if we can't tell which they are
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        return self.errors
+
+    def run(self):
+        '''
+        write out queued invoices until told to stop; any error is
+        recorded rather than let out, since if this thread died,
+        submit() would block forever once the queue filled up
+        '''
+        path = ''
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, data, invoice, temp_path = item
+            try:
+                if temp_path is None:
+                    self.write(path, data, invoice)
+                else:
+                    self.place(temp_path, path, invoice)
+            except Exception as err:  # pylint: disable=broad-except
+                self.errors.append((path, [invoice] if invoice is not None else [], str(err)))
+        try:
+            self.flush()
+        except Exception as err:  # pylint: disable=broad-except
+            self.errors.append((path, [], str(err)))
+
+    def write(self, path, data, invoice=None):
+        '''
+        write the data (bytes) to path; if we are syncing, the rename is
+        put off until a batch of files can be synced together
+        '''
+        self.place(self.write_temp(path, data), path, invoice)
+
+    def place(self, temp_path, path, invoice=None):
+        '''
+        rename the temporary file into place as path; if we are syncing,
+        this is put off until a batch of files can be synced together
+        '''
+        if not self.fsync:
+            os.replace(temp_path, path)
+            return
+        self.pending.append((temp_path, path, invoice))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        sync all pending temporary files, rename them into place,
+        then sync the directories they are in so the renames are durable
+        '''
+        # directory -> Invoices renamed into it
+        dirnames = {}
+        for temp_path, path, invoice in self.pending:
+            try:
+                with open(temp_path, 'rb') as fhandle:
+                    os.fsync(fhandle.fileno())
+                os.replace(temp_path, path)
+            except OSError as err:
+                self.errors.append((path, [invoice] if invoice is not None else [], str(err)))
+                continue
+            invoices = dirnames.setdefault(os.path.dirname(path) or '.', [])
+            if invoice is not None:
+                invoices.append(invoice)
+        self.pending = []
+        for dirname, invoices in dirnames.items():
+            try:
+                self.sync_dir(dirname)
+            except OSError as err:
+                self.errors.append((dirname, invoices, str(err)))
+
+    @staticmethod
+    def sync_dir(dirname):
+        '''sync the directory, so that renames in it are durable'''
+        fdesc = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(fdesc)
+        finally:
+            os.close(fdesc)
+
+
+class ArchiveWriter(InvoiceWriter):
+    '''
+    write rendered invoices on a background thread into a single tar
+    or zip archive rather than one file each, followed by a csv manifest
+    of the invoices in it; the archive is built in a temporary file and
+    renamed into place once it is complete
+
+    invoices are streamed into the archive as they come in, and the
+    manifest is spooled to disk once it grows large, so memory use
+    doesn't grow with the size of the batch (apart from the zip
+    format's own directory of members)
+    '''
+    # archive name endings, and the archive type and mode to open it with for each
+    formats = [('.tar', ('tar', 'w|')), ('.tar.gz', ('tar', 'w|gz')),
+               ('.tgz', ('tar', 'w|gz')), ('.tar.bz2', ('tar', 'w|bz2')),
+               ('.tar.xz', ('tar', 'w|xz')), ('.zip', ('zip', 'w'))]
+    manifest_name = 'manifest.csv'
+    manifest_fields = ['name', 'invoice_number', 'billdate', 'currency_code', 'total',
+                       'offset', 'size']
+
+    def __init__(self, archive_path, fsync=False, queue_size=8):
+        import tarfile
+        import tempfile
+        import zipfile
+        self.archive_path = archive_path
+        kind, mode = ArchiveWriter.get_format(archive_path)
+        self.temp_path = self.write_temp(archive_path, b'')
+        self.fhandle = open(self.temp_path, 'wb')
+        if kind == 'tar':
+            self.tar = tarfile.open(fileobj=self.fhandle, mode=mode,
+                                    format=tarfile.PAX_FORMAT)
+            self.zip = None
+        else:
+            self.tar = None
+            self.zip = zipfile.ZipFile(self.fhandle, mode, compression=zipfile.ZIP_DEFLATED)
+        self.manifest = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        self.add_manifest_row(ArchiveWriter.manifest_fields)
+        # the Invoices added, all of which are lost if the archive can't be finished
+        self.invoices = []
+        super().__init__(fsync=fsync, queue_size=queue_size)
+
+    @staticmethod
+    def get_format(path):
+        '''
+        return ('tar' or 'zip', mode to open it with) for the archive
+        path, based on its name, or None if we don't know it
+        '''
+        for ending, archive_format in ArchiveWriter.formats:
+            if path.lower().endswith(ending):
+                return archive_format
+        return None
+
+    def add_member(self, name, data, mtime):
+        '''
+        add a file with the data (bytes or a file object) to the archive
+        under name, and return the offset of its entry in the archive
+        (in the uncompressed stream, for compressed tar archives)
+        '''
+        import shutil
+        import tarfile
+        import zipfile
+        if self.tar is not None:
+            offset = self.tar.offset
+            info = tarfile.TarInfo(name)
+            info.mtime = mtime
+            info.mode = self.file_mode
+            if isinstance(data, bytes):
+                info.size = len(data)
+                data = io.BytesIO(data)
+            else:
+                data.seek(0, os.SEEK_END)
+                info.size = data.tell()
+                data.seek(0)
+            self.tar.addfile(info, data)
+            return offset
+
+        info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+        info.compress_type = self.zip.compression
+        info.external_attr = self.file_mode << 16
+        if isinstance(data, bytes):
+            self.zip.writestr(info, data)
+        else:
+            data.seek(0)
+            with self.zip.open(info, 'w') as member:
+                shutil.copyfileobj(data, member)
+        return info.header_offset
+
+    def add_manifest_row(self, row):
+        '''add a row to the manifest'''
+        line = io.StringIO()
+        csv.writer(line).writerow(row)
+        self.manifest.write(line.getvalue().encode('utf-8'))
+
+    def write(self, path, data, invoice=None):
+        '''add the data (bytes) to the archive, named for the basename of path'''
+        name = os.path.basename(path)
+        offset = self.add_member(name, data, time.time())
+        if invoice is None:
+            self.add_manifest_row([name, '', '', '', '', offset, len(data)])
+        else:
+            self.add_manifest_row([name, invoice.invoice_number, invoice.billdate,
+                                   invoice.currency_code,
+                                   InvoiceUtils.format_money(invoice.total), offset, len(data)])
+            self.invoices.append(invoice)
+
+    def flush(self):
+        '''
+        add the manifest and finish off the archive, then sync it if
+        we are syncing, and rename it into place
+        '''
+        try:
+            try:
+                self.add_member(ArchiveWriter.manifest_name, self.manifest, time.time())
+            finally:
+                self.manifest.close()
+                if self.tar is not None:
+                    self.tar.close()
+                else:
+                    self.zip.close()
+            if self.fsync:
+                self.fhandle.flush()
+                os.fsync(self.fhandle.fileno())
+            self.fhandle.close()
+            os.replace(self.temp_path, self.archive_path)
+        except Exception as err:  # pylint: disable=broad-except
+            # tarfile and zipfile have errors of their own besides OSError
+            self.fhandle.close()
+            os.unlink(self.temp_path)
+            self.errors.append((self.archive_path, self.invoices, str(err)))
+            return
+        if self.fsync:
+            try:
+                self.sync_dir(os.path.dirname(self.archive_path) or '.')
+            except OSError as err:
+                self.errors.append((self.archive_path, self.invoices, str(err)))
+
+
+class InvoiceMailer():
+    '''
+    email rendered invoices, straight from memory, to the bill_to
+    address on a small pool of threads, each of which keeps its own
+    SMTP connection open for all the invoices it sends, so that a
+    batch pays for connecting, TLS and login once per connection
+    rather than once per invoice
+
+    sends that fail with a temporary error (dropped connection, 4xx
+    reply) are retried on a new connection after a backoff that doubles
+    each time; permanent (5xx) failures are not retried
+    '''
+    defaults = {'port': 0, 'security': 'none', 'username': None, 'password': None,
+                'timeout': 30, 'connections': 2, 'retries': 3, 'backoff': 1.0,
+                'subject': "Invoice {number} from {business}",
+                'body': "Please find attached invoice {number} dated {date}, "
+                        "for a total of {total}.\n"}
+    # default port for each security setting
+    ports = {'none': 25, 'starttls': 587, 'ssl': 465}
+    # the fields that the subject and body can use, as {name}
+    fields = ['number', 'date', 'business', 'total']
+
+    def __init__(self, settings, queue_size=8):
+        self.settings = settings
+        self.errors = []
+        # bounded so that rendering can't get arbitrarily far ahead of sending
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = [threading.Thread(target=self.run, daemon=True)
+                        for _unused in range(settings['connections'])]
+        for thread in self.threads:
+            thread.start()
+
+    @staticmethod
+    def load_settings(path):
+        '''
+        read the mail settings from the yaml file at path, fill in
+        defaults and return them; raise ValueError if they are bad
+        '''
+        import yaml
+        with open(path, "r") as fhandle:
+            try:
+                settings = yaml.safe_load(fhandle)
+            except yaml.YAMLError as err:
+                raise ValueError(str(err)) from err
+        if not isinstance(settings, dict) or not settings.get('host') or not settings.get('from'):
+            raise ValueError("Mail settings " + path + " must give at least 'host' and 'from'")
+        settings = dict(InvoiceMailer.defaults, **settings)
+        if settings['security'] not in InvoiceMailer.ports:
+            raise ValueError("Mail setting 'security' must be one of " +
+                             ", ".join(InvoiceMailer.ports))
+        if not settings['port']:
+            settings['port'] = InvoiceMailer.ports[settings['security']]
+        for setting in ['port', 'timeout', 'connections', 'retries']:
+            settings[setting] = int(settings[setting])
+        settings['backoff'] = float(settings['backoff'])
+        if settings['connections'] < 1:
+            raise ValueError("Mail setting 'connections' must be at least 1")
+        for setting in ['subject', 'body']:
+            # fill it in once now, so that a typo fails here rather than for every invoice
+            settings[setting] = str(settings[setting])
+            try:
+                settings[setting].format(**dict.fromkeys(InvoiceMailer.fields, ''))
+            except (AttributeError, IndexError, KeyError, ValueError) as err:
+                raise ValueError("Mail setting '" + setting + "' can only use the fields {" +
+                                 "}, {".join(InvoiceMailer.fields) + "}, got error: " +
+                                 type(err).__name__ + ": " + str(err)) from err
+        return settings
+
+    def submit(self, invoice, data):
+        '''
+        queue the invoice, rendered as data (bytes), to be sent,
+        waiting if the queue is full
+        '''
+        self.queue.put((invoice, data))
+
+    def close(self):
+        '''
+        wait for all queued invoices to be sent, and return a list
+        of (Invoice, error message) for any that could not be
+        '''
+        for _unused in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.errors
+
+    def connect(self):
+        '''open, secure and log in to an SMTP connection, and return it'''
+        import smtplib
+        import ssl
+        settings = self.settings
+        if settings['security'] == 'ssl':
+            conn = smtplib.SMTP_SSL(settings['host'], settings['port'],
+                                    timeout=settings['timeout'],
+                                    context=ssl.create_default_context())
+        else:
+            conn = smtplib.SMTP(settings['host'], settings['port'], timeout=settings['timeout'])
+            if settings['security'] == 'starttls':
+                conn.starttls(context=ssl.create_default_context())
+        if settings['username']:
+            conn.login(settings['username'], settings['password'] or '')
+        return conn
+
+    @staticmethod
+    def disconnect(conn):
+        '''politely close the connection, if it is still there to close'''
+        import smtplib
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+    @staticmethod
+    def is_permanent(err):
+        '''return True if retrying a send that failed with err won't help'''
+        import smtplib
+        if isinstance(err, smtplib.SMTPRecipientsRefused):
+            return all(code >= 500 for code, _unused in err.recipients.values())
+        if isinstance(err, smtplib.SMTPResponseException):
+            return err.smtp_code >= 500
+        return False
+
+    def get_message(self, invoice, data):
+        '''return the email message for the invoice, with the pdf attached'''
+        import email.message
+        import email.utils
+        fields = {'number': invoice.invoice_number, 'date': invoice.invoice_date,
+                  'business': invoice.business.name,
+                  'total': invoice.currency_marker + ' ' + InvoiceUtils.format_money(invoice.total)}
+        message = email.message.EmailMessage()
+        message['From'] = self.settings['from']
+        message['To'] = invoice.bill_to_email
+        message['Subject'] = self.settings['subject'].format(**fields)
+        message['Date'] = email.utils.formatdate(localtime=True)
+        message['Message-ID'] = email.utils.make_msgid()
+        message.set_content(self.settings['body'].format(**fields))
+        message.add_attachment(data, maintype='application', subtype='pdf',
+                               filename="invoice_" + invoice.invoice_number + ".pdf")
+        return message
+
+    def send(self, conn, invoice, message):
+        '''
+        send the message for the invoice over the connection, or a new
+        one if conn is None, retrying temporary failures; return the
+        connection to use for the next message, which is None if it had
+        to be dropped
+        '''
+        import smtplib
+        attempt = 0
+        while True:
+            try:
+                if conn is None:
+                    conn = self.connect()
+                conn.send_message(message)
+                return conn
+            except (smtplib.SMTPException, OSError) as err:
+                # the connection may be mid-transaction or gone, start over
+                if conn is not None:
+                    self.disconnect(conn)
+                    conn = None
+                if InvoiceMailer.is_permanent(err) or attempt >= self.settings['retries']:
+                    self.errors.append((invoice, str(err)))
+                    return None
+                time.sleep(self.settings['backoff'] * 2 ** attempt)
+                attempt = attempt + 1
+
+    def run(self):
+        '''
+        send queued invoices over one connection until told to stop; any
+        error is recorded rather than let out, since once every thread
+        had died, submit() and close() would block forever
+        '''
+        conn = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            invoice, data = item
+            try:
+                message = self.get_message(invoice, data)
+            except Exception as err:  # pylint: disable=broad-except
+                self.errors.append((invoice, type(err).__name__ + ": " + str(err)))
+                continue
+            try:
+                conn = self.send(conn, invoice, message)
+            except Exception as err:  # pylint: disable=broad-except
+                # we don't know what state the connection was left in
+                if conn is not None:
+                    self.disconnect(conn)
+                    conn = None
+                self.errors.append((invoice, type(err).__name__ + ": " + str(err)))
+        if conn is not None:
+            self.disconnect(conn)
+
+
+def draw_pdf(pdf):
+    '''draw all the tables and other entries of the invoice'''
     # one page invoice, we hope. this will automatically write the
     # header and footer as well.
     pdf.add_page()
@@ -963,26 +1968,232 @@ def render_pdf(config):
     draw.draw_billables_table()
     draw.draw_totals_taxes_table()
 
-    outfile_name = os.path.join(
-        pdf.config['app_config']['output_dir'],
-        "invoice_" + pdf.get_invoice_number() + ".pdf")
 
-    err = pdf.output(outfile_name, 'F')
-    if err:
-        return err
-    return None
+def render_pdf(invoice, writer=None, skeleton=False, incremental=False):
+    '''
+    given an Invoice with all information for the
+    invoice, draw all the tables and other entries and
+    write out the pdf, on the writer's background thread
+    if a writer is passed in; if skeleton is set, the
+    parts of the page that are the same for all invoices
+    from the template are laid out only once per run
+
+    the pdf is returned, unless incremental is set; then
+    each page is written out to a temporary file as soon
+    as it is drawn, rather than the whole document being
+    kept in memory, and the file is renamed into place
+    (on the writer's thread) once it is complete
+    '''
+    from invoice_pdf import PDF
+
+    outfile_name = os.path.join(invoice.output_dir,
+                                "invoice_" + invoice.invoice_number + ".pdf")
+    # default: A4, portrait, all units are in milimeters except for
+    # font sizes, which are in points
+    if incremental:
+        temp_path = InvoiceWriter.write_temp(outfile_name, b'')
+        try:
+            with open(temp_path, 'wb') as fhandle:
+                pdf = PDF(invoice, FIELDS, skeleton, fhandle)
+                draw_pdf(pdf)
+                pdf.close()
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        if writer is None:
+            os.replace(temp_path, outfile_name)
+        else:
+            writer.submit_written(temp_path, outfile_name, invoice)
+        return None
+
+    pdf = PDF(invoice, FIELDS, skeleton)
+    draw_pdf(pdf)
+    data = pdf.output(dest='S')
+    if not isinstance(data, bytes):
+        # manage binary data as latin1 just as fpdf does
+        data = data.encode("latin1")
+    if writer is None:
+        InvoiceWriter.write_atomic(outfile_name, data)
+    else:
+        writer.submit(outfile_name, data, invoice)
+    return data
+
+
+def report_home_totals(invoices, fxrates, fhandle):
+    '''
+    write the total of each invoice, converted into the home currency
+    as of its bill date, and the sum of those, to the file handle; the
+    rates for all the invoices were checked before they were rendered
+    '''
+    home_total = 0
+    for invoice in invoices:
+        converted = fxrates.convert(invoice.total, invoice.currency_code,
+                                    invoice.home_currency, invoice.billdate)
+        home_total = home_total + converted
+        fhandle.write("{date}: {code} {total} = {home} {converted}\n".format(
+            date=invoice.billdate, code=invoice.currency_code,
+            total=InvoiceUtils.format_money(invoice.total), home=invoice.home_currency,
+            converted=InvoiceUtils.format_money(converted)))
+    if invoices:
+        # all invoices come from the same template and so have the same home currency
+        fhandle.write("Total: {home} {total}\n".format(
+            home=invoices[0].home_currency, total=InvoiceUtils.format_money(home_total)))
+
+
+def write_stats():
+    '''
+    write counts of the pages drawn, the size of their content, and the
+    graphics state changes dropped because they were already in effect,
+    and the calls skipped that wouldn't have changed the content anyway,
+    to stderr
+    '''
+    from invoice_pdf import PDF
+    stats = PDF.stats
+    sys.stderr.write("Pages: {pages}, content bytes: {content}\n".format(
+        pages=stats['pages'], content=stats['content_bytes']))
+    sys.stderr.write("Redundant state changes dropped: {ops}, bytes saved: {saved}\n".format(
+        ops=stats['ops_skipped'], saved=stats['bytes_skipped']))
+    sys.stderr.write("Redundant calls skipped that would have written nothing: {calls}\n".format(
+        calls=stats['calls_skipped']))
+
+
+def get_failure(billdate, stage, reason):
+    '''
+    return a description of an invoice that could not be generated,
+    for the failure report
+    '''
+    if isinstance(reason, Exception) and not isinstance(reason, InvoiceError):
+        reason = type(reason).__name__ + ": " + str(reason)
+    return {'billdate': billdate, 'stage': stage, 'reason': str(reason)}
+
+
+def write_failure_report(path, rendered, failures):
+    '''
+    write a json report of the number of invoices generated and
+    the invoices that failed, with the reasons, to the path or to
+    stdout if there is no path
+    '''
+    report = json.dumps({'rendered': rendered, 'failed': len(failures),
+                         'failures': failures}, indent=2) + "\n"
+    if path:
+        InvoiceWriter.write_atomic(path, report.encode('utf-8'))
+    else:
+        sys.stdout.write(report)
+
+
+def render_entries(pdf_config, writer, failures=None, skeleton=False, mailer=None,
+                   incremental=False, fxrates=None):
+    '''
+    fill in defaults for each invoice config entry, check it and render it,
+    and queue it to be emailed if a mailer is passed in, returning the list
+    of Invoices rendered; if exchange rates are passed in, an entry with
+    no rate into the home currency for its bill date is not rendered
+
+    if a list of failures is passed in, bad entries are skipped and a
+    description of each is added to the list; otherwise we exit at
+    the first bad entry
+    '''
+    rendered = []
+    for entry in pdf_config:
+        billdate = entry.get('billdate')
+        stage = 'validate'
+        try:
+            entry = InvoiceConfig.add_config_defaults(entry)
+            entry = InvoiceUtils.set_due_date(entry)
+            errors = []
+            if not InvoiceConfig.validate_config(entry, errors):
+                if failures is None:
+                    usage("Bad yaml configuration, exiting")
+                raise InvoiceError("; ".join(errors))
+            invoice = Invoice.from_config(entry)
+            if mailer is not None and not invoice.bill_to_email:
+                raise InvoiceError("Config bill_to stanza has no email to send the invoice to")
+            if fxrates is not None:
+                stage = 'fx'
+                try:
+                    fxrates.get_rate(invoice.currency_code, invoice.home_currency,
+                                     invoice.billdate)
+                except ValueError as err:
+                    raise InvoiceError(str(err)) from err
+            stage = 'render'
+            data = render_pdf(invoice, writer, skeleton, incremental)
+            if mailer is not None:
+                stage = 'deliver'
+                mailer.submit(invoice, data)
+        except InvoiceError as err:
+            if failures is None:
+                sys.stderr.write(str(err) + "\n")
+                sys.exit(1)
+            failures.append(get_failure(billdate, stage, err))
+        except Exception as err:  # pylint: disable=broad-except
+            # a bad entry can break in all sorts of ways; in keep-going
+            # mode none of them should stop the rest of the batch
+            if failures is None:
+                raise
+            failures.append(get_failure(billdate, stage, err))
+        else:
+            rendered.append(invoice)
+    return rendered
 
 
 def do_main():
     '''entry point'''
-    template, valuesfile = get_args()
-    pdf_config = InvoiceConfig.get_yaml_config(template, valuesfile)
-    for entry in pdf_config:
-        entry = InvoiceConfig.add_config_defaults(entry)
-        entry = InvoiceUtils.set_due_date(entry)
-        if not InvoiceConfig.validate_config(entry):
-            usage("Bad yaml configuration, exiting")
-        render_pdf(entry)
+    args = get_args()
+    failures = None
+    if args['keep_going']:
+        failures = []
+    try:
+        pdf_config = InvoiceConfig.get_yaml_config(args['template'], args['values'],
+                                                   args['timesheet'], args['holidays'], failures,
+                                                   args['billdate'])
+    except InvoiceError as err:
+        sys.stderr.write(str(err) + "\n")
+        sys.exit(1)
+    if args['archive']:
+        try:
+            writer = ArchiveWriter(args['archive'], fsync=args['fsync'])
+        except OSError as err:
+            sys.stderr.write("Failed to create " + args['archive'] + ": " + str(err) + "\n")
+            sys.exit(1)
+    else:
+        writer = InvoiceWriter(fsync=args['fsync'])
+    mailer = None
+    if args['mail']:
+        mailer = InvoiceMailer(args['mail'])
+    try:
+        rendered = render_entries(pdf_config, writer, failures, args['skeleton'], mailer,
+                                  args['incremental'], args['fxrates'])
+    finally:
+        # invoices already rendered are written out (and sent) even if we bail
+        errors = writer.close()
+        send_errors = []
+        if mailer is not None:
+            send_errors = mailer.close()
+    lost = set()
+    for path, invoices, error in errors:
+        sys.stderr.write("Failed to write " + path + ": " + error + "\n")
+        lost.update(id(invoice) for invoice in invoices)
+        if failures is not None:
+            failures.extend([get_failure(invoice.billdate, 'write', path + ": " + error)
+                             for invoice in invoices] or
+                            [get_failure(None, 'write', path + ": " + error)])
+    written = [invoice for invoice in rendered if id(invoice) not in lost]
+    for invoice, error in send_errors:
+        sys.stderr.write("Failed to send invoice " + invoice.invoice_number + " to " +
+                         invoice.bill_to_email + ": " + error + "\n")
+        if failures is not None:
+            failures.append(get_failure(invoice.billdate, 'deliver', error))
+    if args['fxrates']:
+        # the failure report may be going to stdout, which must then be json only
+        report_home_totals(written, args['fxrates'],
+                           sys.stderr if failures is not None and not args['report']
+                           else sys.stdout)
+    if args['stats']:
+        write_stats()
+    if failures is not None:
+        write_failure_report(args['report'], len(written), failures)
+    if errors or send_errors or failures:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,633 @@
+'''
+the pdf document for an invoice, with its header and footer, built on
+fpdf; this is imported only once there is an invoice to render, since
+fpdf takes a while to import
+'''
+import collections
+import struct
+import sys
+import time
+import zlib
+from fpdf import FPDF
+from fpdf.ttfonts import TTFontFile
+
+
+class SubsetTTFontFile(TTFontFile):
+    '''
+    TrueType font reader that keeps the font subsets it makes, so that
+    invoices using the same glyphs of a font share one subset rather than
+    each reading through the font file and building it again
+
+    the subsets are also made without the name table, which pdf readers
+    don't need and which for fonts like DejaVu is mostly license text,
+    larger than all of the glyphs an invoice uses
+    '''
+    # (font file, sorted glyphs) -> (subset font data, code to glyph map, max unicode value)
+    subsets = collections.OrderedDict()
+    max_subsets = 64
+    unneeded_tables = [b'name']
+
+    @staticmethod
+    def get_checksum(data):
+        '''return the TrueType checksum of the data (bytes)'''
+        data = data + b'\0' * (-len(data) % 4)
+        return sum(struct.unpack('>%dL' % (len(data) // 4), data)) & 0xFFFFFFFF
+
+    @staticmethod
+    def drop_tables(data, tags):
+        '''
+        given TrueType font data (bytes) and a list of table tags,
+        return the font data with those tables left out
+        '''
+        num_tables = struct.unpack('>H', data[4:6])[0]
+        tables = []
+        for idx in range(num_tables):
+            tag, _checksum, offset, length = struct.unpack(
+                '>4sLLL', data[12 + 16 * idx:28 + 16 * idx])
+            if tag not in tags:
+                table = data[offset:offset + length]
+                if tag == b'head':
+                    # checksum adjustment must be zero while checksums are computed
+                    table = table[:8] + b'\0\0\0\0' + table[12:]
+                tables.append((tag, table))
+
+        entry_selector = len(tables).bit_length() - 1
+        search_range = 16 << entry_selector
+        header = data[0:4] + struct.pack('>HHHH', len(tables), search_range, entry_selector,
+                                         len(tables) * 16 - search_range)
+        directory = b''
+        body = b''
+        head_offset = None
+        offset = len(header) + 16 * len(tables)
+        for tag, table in tables:
+            if tag == b'head':
+                head_offset = offset + len(body)
+            directory = directory + struct.pack('>4sLLL', tag, SubsetTTFontFile.get_checksum(table),
+                                                offset + len(body), len(table))
+            body = body + table + b'\0' * (-len(table) % 4)
+        data = header + directory + body
+        if head_offset is not None:
+            adjustment = (0xB1B0AFBA - SubsetTTFontFile.get_checksum(data)) & 0xFFFFFFFF
+            data = (data[:head_offset + 8] + struct.pack('>L', adjustment) +
+                    data[head_offset + 12:])
+        return data
+
+    def makeSubset(self, file, subset):  # pylint: disable=invalid-name
+        '''
+        return the font data for the subset of the font file with the glyphs
+        for the listed unicode values, setting up the code to glyph map and
+        max unicode value as fpdf expects
+        '''
+        # the subset made doesn't depend on the order the glyphs were first used in
+        key = (file, tuple(sorted(subset)))
+        if key in SubsetTTFontFile.subsets:
+            SubsetTTFontFile.subsets.move_to_end(key)
+        else:
+            data = self.drop_tables(super().makeSubset(file, subset),
+                                    SubsetTTFontFile.unneeded_tables)
+            SubsetTTFontFile.subsets[key] = (data, self.codeToGlyph, self.maxUni)
+            if len(SubsetTTFontFile.subsets) > SubsetTTFontFile.max_subsets:
+                SubsetTTFontFile.subsets.popitem(last=False)
+        data, self.codeToGlyph, self.maxUni = SubsetTTFontFile.subsets[key]
+        return data
+
+
+# fpdf makes its own TrueType font reader when it writes out the fonts; have it use ours
+sys.modules[FPDF.__module__].TTFontFile = SubsetTTFontFile
+
+
+class StreamBuffer():
+    '''
+    stands in for the string that fpdf builds the finished document up in,
+    writing whatever is added to it straight out to a binary file instead;
+    its length is the number of bytes written so far, which is all fpdf
+    uses it for apart from adding to it
+    '''
+    def __init__(self, fhandle):
+        self.fhandle = fhandle
+        self.length = 0
+
+    def __iadd__(self, text):
+        # manage binary data as latin1 just as fpdf does
+        data = text.encode('latin1')
+        self.fhandle.write(data)
+        self.length = self.length + len(data)
+        return self
+
+    def __len__(self):
+        return self.length
+
+
+class PDF(FPDF):
+    '''
+    subclass with invoice header, footer
+    and some methods to set text, draw and
+    fill colors based on config
+    '''
+    # (family, style, font file) -> (fontkey, font info, font file info) for
+    # unicode fonts already loaded, shared by all invoices in the run
+    loaded_fonts = {}
+    # (fragment name, template, starting state) -> page content and other
+    # results of drawing the fragment, see static_fragment()
+    fragments = {}
+    # attributes restored after replaying a fragment, as drawing it would leave them
+    fragment_state = ['x', 'y', 'lasth', 'font_family', 'font_style', 'font_size_pt',
+                      'font_size', 'underline', 'unifontsubset', 'draw_color', 'fill_color',
+                      'text_color', 'color_flag', 'line_width']
+    # counts of the content drawn and of the graphics state changes dropped
+    # because they wouldn't change anything, for all invoices in the run
+    stats = collections.Counter()
+
+    def __init__(self, invoice, fields, skeleton=False, stream=None):
+        '''
+        if a stream (binary file) is passed in, each page is written out
+        to it as soon as it is finished, followed by the fonts and the rest
+        of the document when it is closed, rather than the whole document
+        being kept in memory until then
+        '''
+        self.invoice = invoice
+        # labels for the header and footer
+        self.fields = fields
+        self.skeleton = skeleton
+        # everything in the invoice that the static fragments depend on
+        self.template_key = repr((invoice.business, invoice.color_light, invoice.color_dark,
+                                  invoice.sans_font, invoice.serif_font, invoice.fonts))
+        super().__init__()
+        self.streaming = stream is not None
+        if self.streaming:
+            self.buffer = StreamBuffer(stream)
+        # object numbers of the pages written out so far, when streaming
+        self.page_objects = []
+        self.add_font('DejaVu', '', '/usr/share/fonts/dejavu/DejaVuSerif.ttf', uni=True)
+        self.add_font('DejaVu', 'B', '/usr/share/fonts/dejavu/DejaVuSerif-Bold.ttf', uni=True)
+        self.add_fonts_from_config()
+        self.margin = 8
+        # A4 paper size. This must be adjusted if caller doesn't use A4.
+        self.page_width = 210 - 16
+
+    def static_fragment(self, name, draw, positioned=False):
+        '''
+        call draw(), which must draw only things that are the same for every
+        invoice from the template, in the same way no matter where on the
+        page we are unless positioned is set
+
+        if the page skeleton is turned on, the page content that draw()
+        writes is recorded the first time, and replayed after that rather
+        than being laid out from scratch
+        '''
+        if not self.skeleton:
+            draw()
+            return
+        key = (name, self.template_key, self.font_family, self.font_style, self.font_size_pt,
+               self.draw_color, self.fill_color, self.text_color, self.line_width)
+        if positioned:
+            key = key + (self.x, self.y)
+        fragment = PDF.fragments.get(key)
+        if fragment is None or not self.replay_fragment(fragment):
+            fragment = self.record_fragment(draw)
+            if fragment is not None:
+                PDF.fragments[key] = fragment
+
+    def record_fragment(self, draw):
+        '''
+        call draw() and return what it did to the document, for
+        replay_fragment(), or None if that can't be replayed
+        '''
+        page = self.page
+        start = len(self.pages[page])
+        fonts = set(self.fonts)
+        images = set(self.images)
+        subsets = dict((fontkey, len(font['subset'])) for fontkey, font in self.fonts.items()
+                       if font['type'] == 'TTF')
+        draw()
+        if self.page != page:
+            return None
+        return {
+            'content': self.pages[page][start:],
+            'fonts': dict((fontkey, dict(font)) for fontkey, font in self.fonts.items()
+                          if fontkey not in fonts),
+            'images': dict((name, dict(info)) for name, info in self.images.items()
+                           if name not in images),
+            'glyphs': dict((fontkey, self.fonts[fontkey]['subset'][subsets[fontkey]:])
+                           for fontkey in subsets),
+            'numbers': dict((fontkey, font['i']) for fontkey, font in self.fonts.items()),
+            'state': dict((attr, getattr(self, attr)) for attr in PDF.fragment_state)}
+
+    def replay_fragment(self, fragment):
+        '''
+        add the page content, fonts, images and glyphs from a fragment
+        recorded by record_fragment() to the document, and leave things
+        as drawing it would have; return False without doing anything
+        if the fonts or images the content refers to by number would not
+        have the same numbers in this document
+        '''
+        numbers = dict((fontkey, font['i']) for fontkey, font in self.fonts.items())
+        for fontkey, font in fragment['fonts'].items():
+            if fontkey not in numbers:
+                numbers[fontkey] = font['i']
+        if numbers != fragment['numbers']:
+            return False
+        count = len(self.images)
+        for name, info in fragment['images'].items():
+            if name not in self.images:
+                count = count + 1
+                if info['i'] != count:
+                    return False
+
+        for fontkey, font in fragment['fonts'].items():
+            if fontkey not in self.fonts:
+                self.fonts[fontkey] = dict(font)
+        for name, info in fragment['images'].items():
+            if name not in self.images:
+                self.images[name] = dict(info)
+        for fontkey, glyphs in fragment['glyphs'].items():
+            self.fonts[fontkey]['subset'].extend(glyphs)
+        self.pages[self.page] += fragment['content']
+        for attr, value in fragment['state'].items():
+            setattr(self, attr, value)
+        if self.font_family:
+            self.current_font = self.fonts[self.font_family + self.font_style]
+        return True
+
+    def add_font(self, family, style='', fname='', uni=False):
+        '''
+        add a font; unicode fonts loaded for an earlier invoice are reused
+        rather than having their metrics read in again
+        '''
+        key = (family.lower(), style.upper(), fname)
+        if not uni or key not in PDF.loaded_fonts:
+            fontkeys = set(self.fonts)
+            super().add_font(family, style, fname, uni)
+            added = [fontkey for fontkey in self.fonts if fontkey not in fontkeys]
+            if uni and added:
+                # the subset is copied too, since it grows with every
+                # character this invoice draws in the font
+                font = self.fonts[added[0]]
+                PDF.loaded_fonts[key] = (added[0], dict(font, subset=list(font['subset'])),
+                                         dict(self.font_files[added[0]]))
+            return
+
+        fontkey, font, font_file = PDF.loaded_fonts[key]
+        if fontkey in self.fonts:
+            return
+        self.fonts[fontkey] = dict(font, i=len(self.fonts) + 1, subset=list(font['subset']))
+        self.font_files[fontkey] = dict(font_file)
+        self.font_files[fname] = {'type': "TTF"}
+
+    def _putfonts(self):
+        '''
+        write out the fonts; fpdf adds a unicode value to the subset of a
+        font each time a character is written in it, so cut each subset
+        down to the distinct values first, which keeps the lookups made
+        while writing the subset and its glyph widths cheap
+        '''
+        for font in self.fonts.values():
+            if font['type'] == 'TTF':
+                font['subset'] = list(dict.fromkeys(font['subset']))
+        super()._putfonts()
+
+    @staticmethod
+    def get_color_op(r, g, b, gray_op, rgb_op):
+        '''
+        return the content stream operator that fpdf writes to set a color,
+        which is gray_op with a single value for black and grays, rgb_op
+        with three values otherwise
+        '''
+        if (r == 0 and g == 0 and b == 0) or g == -1:
+            return '%.3f %s' % (r / 255.0, gray_op)
+        return '%.3f %.3f %.3f %s' % (r / 255.0, g / 255.0, b / 255.0, rgb_op)
+
+    def skip_op(self, op):
+        '''
+        count a state change that was dropped because it was already in
+        effect; if op is None, fpdf wouldn't have written anything for it
+        anyway, so only the call was saved, which is counted separately
+        '''
+        if op is None:
+            PDF.stats['calls_skipped'] += 1
+            return
+        PDF.stats['ops_skipped'] += 1
+        PDF.stats['bytes_skipped'] += len(op) + 1
+
+    def set_draw_color(self, r, g=-1, b=-1):
+        '''set the draw color, unless it's already the current one'''
+        op = PDF.get_color_op(r, g, b, 'G', 'RG')
+        if self.page > 0 and op == self.draw_color:
+            self.skip_op(op)
+            return
+        super().set_draw_color(r, g, b)
+
+    def set_fill_color(self, r, g=-1, b=-1):
+        '''set the fill color, unless it's already the current one'''
+        op = PDF.get_color_op(r, g, b, 'g', 'rg')
+        if self.page > 0 and op == self.fill_color:
+            self.color_flag = (self.fill_color != self.text_color)
+            self.skip_op(op)
+            return
+        super().set_fill_color(r, g, b)
+
+    def set_text_color(self, r, g=-1, b=-1):
+        '''
+        set the text color, unless it's already the current one; this
+        doesn't write anything until text is, so only calls are saved
+        '''
+        if PDF.get_color_op(r, g, b, 'g', 'rg') == self.text_color:
+            self.skip_op(None)
+            return
+        super().set_text_color(r, g, b)
+
+    def set_line_width(self, width):
+        '''set the line width, unless it's already the current one'''
+        if self.page > 0 and width == self.line_width:
+            self.skip_op('%.2f w' % (width * self.k))
+            return
+        super().set_line_width(width)
+
+    def set_font(self, family, style='', size=0):
+        '''
+        set the font, unless it's already the current one; fpdf writes
+        nothing in that case either but only finds out after working
+        out the font key, so only calls are saved
+        '''
+        if (family.lower() == self.font_family and style.upper() == self.font_style and
+                size == self.font_size_pt and not self.underline):
+            self.skip_op(None)
+            return
+        super().set_font(family, style, size)
+
+    def _endpage(self):
+        '''
+        close the page, counting the size of its content, and write it
+        out right away if we are streaming
+        '''
+        PDF.stats['pages'] += 1
+        PDF.stats['content_bytes'] += len(self.pages[self.page])
+        super()._endpage()
+        if self.streaming:
+            self.put_page(self.page)
+            self.put_new_images()
+
+    def put_page(self, page):
+        '''
+        write out the page object and content stream for the page, as fpdf
+        does for all pages at the end, and let go of the content; object 1
+        (the page tree) and 2 (the resources) are written at the end as usual
+        '''
+        if self.page_links or hasattr(self, 'str_alias_nb_pages'):
+            self.error('Links and page number aliases need the whole document in memory')
+        if not self.page_objects:
+            self._putheader()
+        self._newobj()
+        self.page_objects.append(self.n)
+        self._out('<</Type /Page')
+        self._out('/Parent 1 0 R')
+        if page in self.orientation_changes:
+            if self.def_orientation == 'P':
+                self._out('/MediaBox [0 0 %.2f %.2f]' % (self.fh_pt, self.fw_pt))
+            else:
+                self._out('/MediaBox [0 0 %.2f %.2f]' % (self.fw_pt, self.fh_pt))
+        self._out('/Resources 2 0 R')
+        if self.pdf_version > '1.3':
+            self._out('/Group <</Type /Group /S /Transparency /CS /DeviceRGB>>')
+        self._out('/Contents ' + str(self.n + 1) + ' 0 R>>')
+        self._out('endobj')
+        content = self.pages[page].encode('latin1')
+        self.pages[page] = ''
+        content_filter = ''
+        if self.compress:
+            content = zlib.compress(content)
+            content_filter = '/Filter /FlateDecode '
+        self._newobj()
+        self._out('<<' + content_filter + '/Length ' + str(len(content)) + '>>')
+        self._putstream(content)
+        self._out('endobj')
+
+    def put_new_images(self):
+        '''write out images not written yet, and let go of their data'''
+        for _unused, info in sorted([(info['i'], info) for info in self.images.values()
+                                     if 'data' in info], key=lambda item: item[0]):
+            self._putimage(info)
+            del info['data']
+            if 'smask' in info:
+                del info['smask']
+
+    def _putheader(self):
+        '''write the file header, unless the first page already did'''
+        if not self.streaming or not self.page_objects:
+            super()._putheader()
+
+    def _putpages(self):
+        '''
+        write out the pages and then the page tree; when we are streaming the
+        pages are already written, so only the page tree is left to write
+        '''
+        if not self.streaming:
+            super()._putpages()
+            return
+        if self.def_orientation == 'P':
+            w_pt, h_pt = self.fw_pt, self.fh_pt
+        else:
+            w_pt, h_pt = self.fh_pt, self.fw_pt
+        self.offsets[1] = len(self.buffer)
+        self._out('1 0 obj')
+        self._out('<</Type /Pages')
+        self._out('/Kids [' + ''.join([str(obj) + ' 0 R ' for obj in self.page_objects]) + ']')
+        self._out('/Count ' + str(len(self.page_objects)))
+        self._out('/MediaBox [0 0 %.2f %.2f]' % (w_pt, h_pt))
+        self._out('>>')
+        self._out('endobj')
+
+    def _putimages(self):
+        '''write out the images; when we are streaming, most already are'''
+        if not self.streaming:
+            super()._putimages()
+            return
+        self.put_new_images()
+
+    def add_fonts_from_config(self):
+        '''
+        we are doing unicode fonts now. explicitly add them if specified
+        in the template
+        '''
+        for family, style, path in self.invoice.fonts:
+            self.add_font(family, style, path, uni=True)
+
+    def dark_text(self):
+        '''
+        set the text color to the dark color per config
+        '''
+        self.set_text_color(*self.invoice.color_dark)
+
+    def light_text(self):
+        '''
+        set the text color to the light color per config
+        '''
+        self.set_text_color(*self.invoice.color_light)
+
+    def dark_draw_color(self):
+        '''
+        set the draw color to the dark color per config
+        '''
+        self.set_draw_color(*self.invoice.color_dark)
+
+    def light_fill_color(self):
+        '''
+        set the fill color to the light color per config
+        '''
+        self.set_fill_color(*self.invoice.color_light)
+
+    def black_text(self):
+        '''
+        set the text color to black
+        '''
+        self.set_text_color(0, 0, 0)
+
+    def white_text(self):
+        '''
+        set the text color to white
+        '''
+        self.set_text_color(255, 255, 255)
+
+    def serif(self, fontsize):
+        '''
+        set the font to plain serif of the specified size
+        '''
+        self.set_font(self.invoice.serif_font, "", fontsize)
+
+    def bold_serif(self, fontsize):
+        '''
+        set the font to bold serif of the specified size
+        '''
+        self.set_font(self.invoice.serif_font, "B", fontsize)
+
+    def content_cell(self, width, height, text):
+        '''
+        write a filled framed cell with right aligned text
+        which is what we want for most content cells in the
+        invoice tables
+        '''
+        self.cell(width, height, text, border=1, align="R", fill=True)
+
+    def content_cell_left(self, width, height, text):
+        '''
+        write a filled framed cell with left aligned text
+        which a few content cells need
+        '''
+        self.cell(width, height, text, border=1, fill=True)
+
+    def header_cell(self, width, height, text):
+        '''
+        write a filled framed cell with centered text
+        which is what we want for most header cells in the
+        invoice tables
+        '''
+        self.cell(width, height, text, border=1, align="C", fill=True)
+
+    def blank_cell(self, width, height):
+        '''
+        write a transparent borderless cell with no text, which is the
+        default for all the args except of course for the empty
+        text string
+        '''
+        # self.cell(width, height, "", align="C", fill=True)
+        self.cell(width, height, "")
+
+    def draw_divider(self, ypos):
+        '''draw a dividing line across the page 10 line breaks below our current pos'''
+        self.ln(10)
+        self.dark_draw_color()
+        self.line(self.margin, ypos, self.page_width + self.margin, ypos)
+
+    def header(self):
+        '''
+        Display at top of the invoice:
+        logo if any, biller name and address, invoice number and date,
+        divider line to separate the header from the body of the invoice
+        '''
+        # Right side
+        # invoice date and number, after their labels
+        right_x = 140
+        right_width = 20
+        self.serif(10)
+        self.light_text()
+        self.set_xy(right_x + right_width, 40)
+        self.cell(20, 0, self.invoice.invoice_date)
+        self.set_xy(right_x + right_width, 45)
+        self.cell(right_width, 0, self.invoice.invoice_number)
+
+        self.static_fragment('header', self.header_static)
+
+    def header_static(self):
+        '''
+        Display the parts of the header that are the same for every
+        invoice from the template
+        '''
+        # logo
+        if self.invoice.business.image_file:
+            self.image(self.invoice.business.image_file, 0, 10, 100, 0, '', '')
+
+        # Right side
+        # "Invoice"
+        right_x = 140
+        self.set_font(self.invoice.sans_font, "BI", 28)
+        self.set_xy(right_x, 30)
+        self.dark_text()
+        self.cell(40, 0, self.fields['header']['invoice'])
+
+        # Rest of right side
+        self.serif(10)
+        right_width = 20
+        # "Date"
+        self.set_xy(right_x, 40)
+        self.cell(right_width, 0, self.fields['header']['date'])
+        # "Invoice Number"
+        self.set_xy(right_x, 45)
+        self.cell(right_width, 0, self.fields['header']['invoice_num'])
+
+        # Left side
+        self.dark_text()
+        left_width = 40
+        # Biller Name
+        self.bold_serif(14)
+        self.set_xy(self.margin, 40)
+        self.cell(left_width, 0, self.invoice.business.person)
+        # Biller Address
+        self.serif(9)
+        self.set_xy(self.margin, 45)
+        self.cell(left_width, 0, self.invoice.business.address)
+
+        self.draw_divider(50)
+
+    def footer(self):
+        '''
+        Display at bottom of the invoice:
+        divider line to separate footer from body of the invoice,
+        company name, date invoice generated
+        '''
+        self.static_fragment('footer', self.footer_static)
+
+        # Right side
+        # invoice generation date
+        self.light_text()
+        time_text = self.fields['footer']['generated'] + ' '  + time.strftime(
+            "%Y-%m-%d %H:%M:%S UTC", time.gmtime())
+        # add in left margin for correct placement
+        self.set_x(self.page_width - self.get_string_width(time_text) + self.margin)
+        self.cell(self.get_string_width(time_text), 0, time_text)
+
+    def footer_static(self):
+        '''
+        Display the parts of the footer that are the same for every
+        invoice from the template
+        '''
+        self.draw_divider(275)
+
+        # Text
+        self.bold_serif(10)
+
+        # Left side
+        # company name
+        self.set_xy(self.margin, 280)
+        self.dark_text()
+        company_text = self.invoice.business.name
+        self.cell(self.get_string_width(company_text), 0, company_text)